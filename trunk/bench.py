@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+#
+# bench - timing of the pos2exif / exif2kml building blocks
+#
+# Copyright (C) 2006  Michael Strecke
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+import sys, os, time, datetime, tempfile, shutil, random, multiprocessing, subprocess
+import py_compile
+
+import pos2exiflib, exif2kml
+
+# synthetic track: one point per second, starting at 2006-07-07 10:00:00 UTC
+
+def trackpoints(num):
+   t = datetime.datetime(2006,7,7,10,0,0)
+   sec = datetime.timedelta(seconds = 1)
+   for i in xrange(num):
+      yield (t, 6.0 + i * 0.00001, 50.0 + i * 0.00001, 100.0 + (i % 50))
+      t += sec
+
+def nmeapos(value,pos,neg,width):
+   if value >= 0:
+      hemi = pos
+   else:
+      hemi = neg
+      value = -value
+   deg = int(value)
+   return "%0*d%07.4f,%s" % (width,deg,(value - deg) * 60.0,hemi)
+
+def writegpx(fnm,num):
+   f = open(fnm,"w")
+   f.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1">\n<trk><trkseg>\n')
+   for (t,lon,lat,ele) in trackpoints(num + 1):   # the GPX reader skips the first point
+      f.write('<trkpt lat="%.6f" lon="%.6f"><ele>%.1f</ele><time>%s</time></trkpt>\n' % (lat,lon,ele,t.strftime("%Y-%m-%dT%H:%M:%SZ")))
+   f.write('</trkseg></trk>\n</gpx>\n')
+   f.close()
+
+def writenmea(fnm,num):
+   f = open(fnm,"w")
+   for (t,lon,lat,ele) in trackpoints(num):
+      ts = t.strftime("%H%M%S")
+      for body in ("GPGGA,%s.00,%s,%s,1,08,0.9,%.1f,M,47.0,M,," % (ts,nmeapos(lat,"N","S",2),nmeapos(lon,"E","W",3),ele),
+                   "GPRMC,%s.00,A,%s,%s,0.0,0.0,%s,,,A" % (ts,nmeapos(lat,"N","S",2),nmeapos(lon,"E","W",3),t.strftime("%d%m%y"))):
+         f.write("$%s*%02X\n" % (body,pos2exiflib.nmeachecksum(body)))
+   f.close()
+
+def writecsv(fnm,num):
+   f = open(fnm,"w")
+   f.write("time,lat,lon,ele\n")
+   for (t,lon,lat,ele) in trackpoints(num):
+      f.write("%s,%.6f,%.6f,%.1f\n" % (t.strftime("%Y-%m-%dT%H:%M:%SZ"),lat,lon,ele))
+   f.close()
+
+def timeit(func,*args):
+   start = time.time()
+   res = func(*args)
+   return (time.time() - start, res)
+
+def bench_track(num = 100000):
+   """ points per second of the GPX, NMEA and CSV track readers """
+   tmp = tempfile.mkdtemp()
+   try:
+      print "Track readers, %s points" % (num,)
+      for (ext,writer) in ((".gpx",writegpx),(".nmea",writenmea),(".csv",writecsv)):
+         fnm = os.path.join(tmp,"track" + ext)
+         writer(fnm,num)
+         (dt,pts) = timeit(pos2exiflib.readTrack,fnm)
+         print "%6s: %8d points %8.3f s %10.0f points/s" % (ext,len(pts),dt,len(pts) / dt)
+   finally:
+      shutil.rmtree(tmp)
+
+def wiggletrack(num):
+   """ track with some GPS noise and a turn every 600 points """
+   random.seed(1)
+   res = []
+   lon = 6.0
+   lat = 50.0
+   dlon = 0.00001
+   dlat = 0.0
+   for (t,x,y,ele) in trackpoints(num):
+      if random.random() < 1.0 / 600:
+         (dlon,dlat) = (-dlat,dlon)
+      lon += dlon
+      lat += dlat
+      res.append((t,lon + random.gauss(0,0.00002),lat + random.gauss(0,0.00002),ele))
+   return res
+
+def bench_simplify(num = 1000000):
+   """ run time and point reduction of the track simplifiers """
+   track = wiggletrack(num)
+   print "Track simplification, %s points, tolerance %s m" % (num,exif2kml.tracktolerance)
+   for method in sorted(exif2kml.simplifiers):
+      (dt,simple) = timeit(exif2kml.simplifiers[method],track,exif2kml.tracktolerance)
+      print "%6s: %8d points %8.3f s %10.0f points/s" % (method,len(simple),dt,num / dt)
+
+def bench_lookup(num = 100000):
+   """ lookups per second with binary search and with the time bucket index """
+   random.seed(1)
+   track = irregulartrack(num,(1,1,1,2,5))
+   span = pos2exiflib.tdseconds(track[-1][0] - track[0][0])
+   times = [track[0][0] + datetime.timedelta(seconds = random.uniform(0,span)) for i in xrange(num)]
+
+   (dt,index) = timeit(pos2exiflib.trackindex,track)
+   print "Track lookup, %s points, %s lookups, index built in %.3f s" % (num,len(times),dt)
+   for (name,index) in (("bisect",None),("bucket",index)):
+      start = time.time()
+      for t in times:
+         pos2exiflib.lookupTrack(track,t,index)
+      dt = time.time() - start
+      print "%6s: %8.3f s %10.0f lookups/s" % (name,dt,len(times) / dt)
+
+def bench_jobs(num = 1000):
+   """ images per second of exif2kml.readimages with 1, 2, 4 ... workers
+
+       needs exiftool and the images in the directory named by the
+       environment variable BENCH_IMAGES
+   """
+   imdir = os.environ.get("BENCH_IMAGES")
+   if not imdir:
+      print "Image data extraction: set BENCH_IMAGES to a directory with images"
+      return
+   fnmlist = [os.path.join(imdir,f) for f in sorted(os.listdir(imdir))][:num]
+
+   print "Image data extraction, %s images" % (len(fnmlist),)
+   jobs = 1
+   while jobs <= max(8,multiprocessing.cpu_count()):
+      cnt = [0]
+      out = sys.stdout
+      sys.stdout = open(os.devnull,"w")       # silence the per file output
+      try:
+         start = time.time()
+         for po in exif2kml.readimages(fnmlist,cnt,jobs):
+            pass
+         dt = time.time() - start
+      finally:
+         sys.stdout.close()
+         sys.stdout = out
+      print "%3d jobs: %8.3f s %10.1f images/s" % (jobs,dt,len(fnmlist) / dt)
+      jobs *= 2
+
+def tablesize(table):
+   """ bytes of an exif2kml.imagetable with all its strings """
+   size = sum([sys.getsizeof(a) for a in (table.time,table.lat,table.lon,table.alt,table.dir,table.name,table.thumb,table.dirs,table.dirindex)])
+   seen = {}
+   for s in table.name + table.thumb + table.dirs:
+      if id(s) not in seen:
+         seen[id(s)] = True
+         size += sys.getsizeof(s)
+   return size
+
+def tuplesize(tuples):
+   """ bytes of a list of tuples with all their members """
+   size = sys.getsizeof(tuples)
+   seen = {}
+   for p in tuples:
+      for o in (p,) + p:
+         if id(o) not in seen:
+            seen[id(o)] = True
+            size += sys.getsizeof(o)
+   return size
+
+def images(num,persec = 10):
+   """ image records in random order, persec per second in ten directories """
+   random.seed(1)
+   t0 = 1152266400
+   res = []
+   for i in xrange(num):
+      res.append(exif2kml.imagerecord(t0 + i // persec,50.0 + random.random(),6.0 + random.random(),100.0 + i,"/photos/2006/07/card%d" % (i % 10,),"IMG_%06d.JPG" % (i,)))
+   random.shuffle(res)
+   return res
+
+def bench_records(num = 100000):
+   """ memory per image and sort time: tuples with datetime vs. exif2kml.imagetable """
+   records = images(num)
+   tuples = [(datetime.datetime.utcfromtimestamp(r.time),r.lat,r.lon,r.alt,r.name) for r in records]
+   table = exif2kml.imagetable()
+   for r in records:
+      table.append(r)
+   print "Image records, %s images in %s directories" % (num,len(table.dirs))
+   print " tuple: %6.1f bytes/record" % (float(tuplesize(tuples)) / num,)
+   print " table: %6.1f bytes/record (directory included)" % (float(tablesize(table)) / num,)
+
+   for persec in (1,10):
+      records = images(num,persec)
+      tuples = [(datetime.datetime.utcfromtimestamp(r.time),r.lat,r.lon,r.alt,r.name) for r in records]
+      table = exif2kml.imagetable()
+      for r in records:
+         table.append(r)
+      (dt,x) = timeit(sorted,tuples)
+      print " tuple: sorted in %.3f s (%s images per second)" % (dt,persec)
+      (dt,x) = timeit(table.sort)
+      print " table: sorted in %.3f s (%s images per second)" % (dt,persec)
+
+recordlimit = 120.0      # bytes per image in an imagetable
+
+def check_records(num = 100000):
+   """ an imagetable stays below recordlimit bytes per image and sorts
+       like the tuples (time, lat, lon, alt, name)
+   """
+   records = images(num)
+   table = exif2kml.imagetable()
+   for r in records:
+      table.append(r)
+   size = float(tablesize(table)) / num
+   table.sort()
+   ok = [r.key() for r in table] == sorted([r.key() for r in records])
+   print "Image table, %s images: %.1f bytes/record (limit %.0f), sort order %s" % (num,size,recordlimit,ok and "ok" or "wrong")
+   return size > recordlimit or not ok
+
+nmeasample = ["$GPGGA,123519,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,*47\n",
+              "$GPRMC,123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W*6A\n"]
+
+def check_nmea(num = 1000):
+   """ the NMEA reader checks the checksums and reads $GN sentences """
+   tmp = tempfile.mkdtemp()
+   fnm = os.path.join(tmp,"track.nmea")
+   gn = []
+   for line in nmeasample:
+      body = "GN" + line[3:line.index("*")]
+      gn.append("$%s*%02X\n" % (body,pos2exiflib.nmeachecksum(body)))
+   cases = (
+      ("valid",nmeasample,1),
+      ("corrupted",[nmeasample[0],nmeasample[1].replace("4807.038","4817.038")],0),
+      ("$GN",gn,1),
+   )
+   failed = False
+   try:
+      for (name,lines,expected) in cases:
+         open(fnm,"w").writelines(lines)
+         num = len(pos2exiflib.readTrack(fnm))
+         if num != expected:
+            print "NMEA %s: %s points instead of %s" % (name,num,expected)
+            failed = True
+      writenmea(fnm,1000)
+      if len(pos2exiflib.readTrack(fnm)) != 1000:
+         print "NMEA: writenmea output not read completely"
+         failed = True
+   finally:
+      shutil.rmtree(tmp)
+   print "NMEA checksums: %s" % (failed and "failed" or "ok",)
+   return failed
+
+def irregulartrack(num,steps):
+   """ track with the time steps (in seconds) picked at random from steps """
+   track = []
+   t = datetime.datetime(2006,7,7,10,0,0)
+   for (x,lon,lat,ele) in trackpoints(num):
+      track.append((t,lon,lat,ele))
+      t += datetime.timedelta(seconds = random.choice(steps))
+   return track
+
+def check_lookup(num = 200):
+   """ lookupTrack with the time bucket index agrees with the binary search """
+   random.seed(1)
+   t0 = datetime.datetime(2006,7,7,10,0,0)
+   # the last bucket start of this track is rounded to just after its end
+   tracks = [[(t0 + datetime.timedelta(seconds = s),6.0,50.0,None) for s in range(21) + [27]]]
+   for steps in ((1,),(1,1,1,2,5),(1,30),(1,1,1,1,600),(3,7,11)):
+      for n in (1,2,3,22,num):
+         tracks.append(irregulartrack(n,steps))
+
+   errors = 0
+   for track in tracks:
+      index = pos2exiflib.trackindex(track)
+      times = [p[0] for p in track]
+      span = pos2exiflib.tdseconds(track[-1][0] - track[0][0])
+      times += [track[0][0] + datetime.timedelta(seconds = random.uniform(0,span)) for i in xrange(num)]
+      times += [track[0][0] - datetime.timedelta(seconds = 1),track[-1][0] + datetime.timedelta(seconds = 1)]
+      for t in times:
+         try:
+            res = pos2exiflib.lookupTrack(track,t,index)
+         except IndexError, e:
+            res = e
+         if res != pos2exiflib.lookupTrack(track,t):
+            errors += 1
+   # interpolation over a gap of more than a day (maxgap 0: no limit)
+   track = [(t0,6.0,50.0,100.0),(t0 + datetime.timedelta(days = 2),7.0,51.0,200.0)]
+   mid = pos2exiflib.lookupTrack(track,t0 + datetime.timedelta(days = 1))
+   if abs(mid[1] - 6.5) > 1e-9 or abs(mid[2] - 50.5) > 1e-9 or abs(mid[3] - 150.0) > 1e-9:
+      print "Track lookup over two days: %s" % (mid,)
+      errors += 1
+
+   print "Track lookup, %s tracks: %s mismatches" % (len(tracks),errors)
+   return errors > 0
+
+lightcommands = (["help"],["gpstz","1"],["maxgap","60"],["listsync"])
+heavymodules = ("xml.dom.minidom","pyexpat","datetime","csv","hashlib","shutil","tempfile")
+
+importcheck = """
+import sys, os
+sys.argv = %r
+sys.path.insert(0,os.path.dirname(sys.argv[0]))
+try:
+   execfile(sys.argv[0],{"__name__": "__main__"})
+except SystemExit:
+   pass
+sys.stderr.write(" ".join([m for m in %r if m in sys.modules]))
+"""
+
+def pos2exifcommand(args,func):
+   """ runs func(script,args,env) for the pos2exif command args with an
+       empty home directory
+   """
+   script = os.path.join(os.path.dirname(os.path.abspath(__file__)),"pos2exif.py")
+   home = tempfile.mkdtemp()
+   env = dict(os.environ)
+   env["HOME"] = home
+   try:
+      return func(script,args,env)
+   finally:
+      shutil.rmtree(home)
+
+def heavyimports(script,args,env):
+   p = subprocess.Popen([sys.executable,"-c",importcheck % ([script] + args,heavymodules)],stdout = open(os.devnull,"w"),stderr = subprocess.PIPE,env = env)
+   return p.communicate()[1].split()
+
+def check_imports():
+   """ the lightweight pos2exif commands do not import the XML, track or
+       EXIF machinery
+   """
+   failed = False
+   for args in lightcommands:
+      heavy = pos2exifcommand(args,heavyimports)
+      if heavy:
+         failed = True
+         print "pos2exif %s imports %s" % (args[0]," ".join(heavy))
+   print "Imports of %s lightweight commands: %s" % (len(lightcommands),failed and "failed" or "ok")
+   return failed
+
+startupfactor = 1.5     # budget: times the start of a bare interpreter
+
+def bench_startup(num = 20):
+   """ run time of the lightweight pos2exif commands
+
+       the budget is measured: starting the interpreter without a script
+       takes most of the time, a command may add half of that
+   """
+   def runtime(script,args,env):
+      # fastest run: the others are slowed down by the rest of the system
+      best = None
+      for i in xrange(num):
+         start = time.time()
+         subprocess.call([sys.executable,script] + args,stdout = open(os.devnull,"w"),env = env)
+         dt = (time.time() - start) * 1000.0
+         if best == None or dt < best:
+            best = dt
+      return best
+
+   # pos2exif.py only imports pos2exiflib, which is loaded from the .pyc
+   # (also if PYTHONDONTWRITEBYTECODE kept the imports from writing it)
+   py_compile.compile(pos2exiflib.__file__.replace(".pyc",".py"))
+
+   baseline = runtime("-c",["pass"],os.environ)
+   budget = baseline * startupfactor
+   print "Startup time, interpreter %.1f ms, budget %.1f ms, fastest of %s runs" % (baseline,budget,num)
+   for args in lightcommands:
+      dt = pos2exifcommand(args,runtime)
+      res = "ok"
+      if dt > budget:
+         res = "over budget"
+      print "%10s: %6.1f ms  %s" % (args[0],dt,res)
+
+benchmarks = {
+   "track": bench_track,
+   "lookup": bench_lookup,
+   "jobs": bench_jobs,
+   "records": bench_records,
+   "startup": bench_startup,
+   "simplify": bench_simplify,
+}
+
+# the checks run before every benchmark, on errors bench.py exits with 1
+# without running the benchmarks
+checks = {
+   "lookup": check_lookup,
+   "records": check_records,
+   "imports": check_imports,
+   "nmea": check_nmea,
+}
+
+def usage():
+   print "usage: bench.py [benchmark [size]]"
+   print "       bench.py check"
+   print "available benchmarks:", " ".join(sorted(benchmarks))
+
+if __name__ == "__main__":
+   args = sys.argv[1:]
+   if not args:
+      names = sorted(benchmarks)
+   elif args[0] == "check" and len(args) == 1:
+      names = []
+   elif args[0] in benchmarks:
+      names = [args[0]]
+   else:
+      usage()
+      sys.exit(1)
+
+   failed = False
+   for name in sorted(checks):
+      failed = checks[name]() or failed
+   if failed:
+      sys.exit(1)
+   for name in names:
+      if len(args) > 1:
+         benchmarks[name](int(args[1]))
+      else:
+         benchmarks[name]()
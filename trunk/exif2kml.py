@@ -20,11 +20,20 @@
 #
 
 
-import sys, os, re, datetime, math, cgi
+import sys, os, re, datetime, math, cgi, getopt, tempfile, shutil, zipfile
+import time, struct, zlib, heapq, itertools, multiprocessing, hashlib
+import operator, calendar, array
+
+import pos2exiflib
 
 version = "0.1"
 maxradius = 45
 maxpics = 6
+tiledepth = 16       # depth of the quadtree for tiled output
+tilemaxpics = 100    # max. number of placemarks in a tile of the tiled output
+sortchunk = 200000   # max. number of images sorted in memory
+tracktolerance = 5.0 # tolerance of the track simplification in metres
+thumbcache = "~/.pos2exif/thumbs"   # cache of the extracted thumbnails
 
 # Convert functions
 
@@ -56,6 +65,131 @@ def distance(longS, latS, longD, latD):
    
    return dist
 
+class imagerecord(object):
+   """ data of one image: time (seconds since 1970, camera time), lat,
+       lon, alt, directory, file name and archive name of the thumbnail
+
+       The records pass the images from the readers to the sort and from
+       the sort to the clustering. No per instance dictionary, an integer
+       time and one shared (interned) string per directory. Records sort
+       like the former tuples: by time, lat, lon, alt and file name.
+   """
+
+   __slots__ = ("time","lat","lon","alt","dir","name","thumb")
+
+   def __init__(self,time,lat,lon,alt,dir,name,thumb = None):
+      self.time = time
+      self.lat = lat
+      self.lon = lon
+      self.alt = alt
+      self.dir = intern(dir)
+      self.name = name
+      self.thumb = thumb
+
+   def key(self):
+      return (self.time,self.lat,self.lon,self.alt,self.name)
+
+   def __lt__(self,other):
+      return self.key() < other.key()
+
+   def __getstate__(self):
+      return (self.time,self.lat,self.lon,self.alt,self.dir,self.name,self.thumb)
+
+   def __setstate__(self,state):
+      self.__init__(*state)
+
+   def timestr(self):
+      return time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime(self.time))
+
+   def line(self):
+      """ the record as a line of the spool and partial files, see parserecord """
+      return "%d\t%r\t%r\t%r\t%s\t%s\t%s\n" % (self.time,self.lat,self.lon,self.alt,self.dir.encode("string_escape"),self.name.encode("string_escape"),(self.thumb or "").encode("string_escape"))
+
+def parserecord(line):
+   """ imagerecord of a line written by imagerecord.line:
+
+       time <tab> lat <tab> lon <tab> alt <tab> directory <tab> file name <tab> thumbnail
+
+       time in seconds since 1970, tabs, newlines and backslashes in the
+       names are escaped, an empty thumbnail field means no thumbnail.
+       Raises ValueError for other lines.
+   """
+   f = line.rstrip("\n").split("\t")
+   if len(f) != 7:
+      raise ValueError, "not an image record"
+   return imagerecord(int(f[0]),float(f[1]),float(f[2]),float(f[3]),f[4].decode("string_escape"),f[5].decode("string_escape"),f[6].decode("string_escape") or None)
+
+class imagetable(object):
+   """ column store of the images of a sort chunk
+
+       time, lat, lon and alt are kept in arrays, the directory as index
+       into the table of distinct directories. Only the file name (and the
+       thumbnail name) is an object of its own. Indexing and iterating
+       yield imagerecords.
+   """
+
+   def __init__(self):
+      self.time = array.array("l")
+      self.lat = array.array("d")
+      self.lon = array.array("d")
+      self.alt = array.array("d")
+      self.dir = array.array("i")
+      self.name = []
+      self.thumb = []
+      self.dirs = []       # distinct directories
+      self.dirindex = {}   # directory -> index in dirs
+
+   def __len__(self):
+      return len(self.time)
+
+   def append(self,po):
+      d = self.dirindex.get(po.dir)
+      if d == None:
+         d = len(self.dirs)
+         self.dirs.append(po.dir)
+         self.dirindex[po.dir] = d
+      self.time.append(po.time)
+      self.lat.append(po.lat)
+      self.lon.append(po.lon)
+      self.alt.append(po.alt)
+      self.dir.append(d)
+      self.name.append(po.name)
+      self.thumb.append(po.thumb)
+
+   def __getitem__(self,i):
+      return imagerecord(self.time[i],self.lat[i],self.lon[i],self.alt[i],self.dirs[self.dir[i]],self.name[i],self.thumb[i])
+
+   def __iter__(self):
+      for i in xrange(len(self.time)):
+         yield self[i]
+
+   def rowkey(self,i):
+      return (self.time[i],self.lat[i],self.lon[i],self.alt[i],self.name[i])
+
+   def sort(self):
+      """ sort the rows in the order of imagerecord """
+      t = self.time
+      order = sorted(xrange(len(t)),key = t.__getitem__)
+
+      # rows with the same time are ordered by the rest of the key,
+      # ties yields the positions i with the same time as position i+1
+      st = array.array("l",itertools.imap(t.__getitem__,order))
+      ties = itertools.compress(itertools.count(),itertools.imap(operator.eq,st,itertools.islice(st,1,None)))
+      runs = []
+      for i in ties:
+         if runs and runs[-1][1] == i:
+            runs[-1][1] = i + 1
+         else:
+            runs.append([i,i + 1])
+      for (start,end) in runs:
+         order[start:end + 1] = sorted(order[start:end + 1],key = self.rowkey)
+
+      for col in ("time","lat","lon","alt","dir"):
+         a = getattr(self,col)
+         setattr(self,col,array.array(a.typecode,itertools.imap(a.__getitem__,order)))
+      self.name = map(self.name.__getitem__,order)
+      self.thumb = map(self.thumb.__getitem__,order)
+
 def getImageData(fnm):
    # TODO: sanatize fnm
    cmd = "exiftool -e -S -c \"%%.10f\" -GPSLongitude -GPSLongitudeRef -GPSLatitude -GPSLatitudeRef -GPSAltitude -GPSAltitudeRef -CreateDate \"%s\"" % (fnm,)
@@ -114,7 +248,8 @@ def getImageData(fnm):
    if lon==None or lat == None or crea == None:
       raise ValueError,"data incomplete"
 
-   return (crea, lat * latfac, lon * lonfac, alt * altfac,os.path.basename(fnm))
+   (d,name) = os.path.split(fnm)
+   return imagerecord(calendar.timegm(crea.timetuple()), lat * latfac, lon * lonfac, alt * altfac, d, name)
 
 """ Simple Format
 <?xml version="1.0" encoding="UTF-8"?>
@@ -138,83 +273,125 @@ def getImageData(fnm):
 <description><![CDATA[ html text ]]></description>
 """
 
-def outputgrouplist(dev,liste,startname,startzeit,endname,endzeit,maxpics):
+# Thumbnails
+#
+# The thumbnail embedded in the EXIF data is extracted by exiftool without
+# decoding the image. The thumbnails are cached in thumbcache, the cache
+# key is the path, size and modification time of the image, so unchanged
+# images are never read twice. An empty cache file marks an image without
+# thumbnail, it is only written if exiftool succeeded. The partial files
+# of sharded runs store the archive names only, so --merge finds the
+# thumbnails of other hosts only if their caches were copied over.
+
+def getThumbnail(fnm):
+   """ archive name of the thumbnail of image fnm in the KMZ, None if there is none
+   """
+   st = os.stat(fnm)
+   key = hashlib.md5("%s\0%s\0%s" % (os.path.realpath(fnm),st.st_size,st.st_mtime)).hexdigest()
+   cfnm = os.path.join(os.path.expanduser(thumbcache),key + ".jpg")
+   if not os.path.exists(cfnm):
+      cmd = "exiftool -b -ThumbnailImage \"%s\"" % (fnm,)
+      pipe = os.popen(cmd)
+      res = pipe.read()
+      if pipe.close():
+         # exiftool failed (missing, killed, I/O error), try again next time
+         return None
+      # write and rename, other workers may read the cache at the same time
+      f = open(cfnm + ".%s" % (os.getpid(),),"wb")
+      f.write(res)
+      f.close()
+      os.rename(cfnm + ".%s" % (os.getpid(),),cfnm)
+   if os.path.getsize(cfnm) == 0:
+      return None
+   return "thumbs/" + key + ".jpg"
+
+def thumbfile(arcname):
+   """ cache file of a thumbnail """
+   return os.path.join(os.path.expanduser(thumbcache),os.path.basename(arcname))
+
+def thumbhtml(p,thumbs):
+   """ <img> tag of the thumbnail of image p (if any), the archive name is logged to thumbs
+   """
+   if thumbs == None or p.thumb == None:
+      return ""
+   if not os.path.exists(thumbfile(p.thumb)):
+      # image read on another host, see --merge
+      print "Warning: thumbnail of %s not in %s" % (p.name,thumbcache)
+      return ""
+   thumbs.write(p.thumb + "\n")
+   return '<img src="%s"><br>' % (p.thumb,)
+
+def groupcenter(liste):
+   """ mean position of a group: (lon, lat, ele)
+   """
    num = len(liste)
-   if num == 0:
-      return
-      
    sumlon = 0
    sumlat = 0
    sumele = 0
    for p in liste:
-      sumlon += p[2]
-      sumlat += p[1]
-      sumele += p[3]
+      sumlon += p.lon
+      sumlat += p.lat
+      sumele += p.alt
    
-   sumlon /= num
-   sumlat /= num
-   sumele /= num
+   return (sumlon / num, sumlat / num, sumele / num)
+
+def outputgrouplist(dev,liste,maxpics,thumbs = None):
+   num = len(liste)
+   if num == 0:
+      return
+      
+   (sumlon,sumlat,sumele) = groupcenter(liste)
+   startname = liste[0].name
+   startzeit = liste[0].timestr()
+   endzeit = liste[num-1].timestr()
    
    if num == 1:
       name = startname
       description = "Picture %s<br>%s" % (startname,startzeit)
+      img = thumbhtml(liste[0],thumbs)
+      if img:
+         description += "<br>" + img
    else:
       name = "%s (%s)" % (startname,num)
-      description = "<b>%s pictures</b><br>%s -<br>%s<br>" % (num,startzeit,endzeit)
+      description = ["<b>%s pictures</b><br>%s -<br>%s<br>" % (num,startzeit,endzeit)]
       
       for p in range(min(num,maxpics-1)):
-         description += "%s<br>" % (cgi.escape(liste[p][4]),)
+         description.append("%s<br>%s" % (cgi.escape(liste[p].name),thumbhtml(liste[p],thumbs)))
       if num > maxpics:
-         description += "...<br>"
+         description.append("...<br>")
       if num >= maxpics:
-         description += "%s<br>" % (cgi.escape(liste[num-1][4]),)
+         description.append("%s<br>%s" % (cgi.escape(liste[num-1].name),thumbhtml(liste[num-1],thumbs)))
+      description = "".join(description)
       
    
-   dev.write("<Placemark>\n<name>%s</name>\n<description><![CDATA[%s]]></description>\n" % (name, description))
-   dev.write("<Point><coordinates>%s,%s,%s</coordinates></Point>\n</Placemark>\n" % (sumlon,sumlat,sumele))
+   dev.write("<Placemark>\n<name>%s</name>\n<description><![CDATA[%s]]></description>\n<Point><coordinates>%s,%s,%s</coordinates></Point>\n</Placemark>\n" % (name,description,sumlon,sumlat,sumele))
 
 def remainingpointswithindistance(liste,meanlon,meanlat,max):
    """ check if all points in the point list are within a max. radius around the median point
    """
    for p in liste:
-      if distance(p[2],p[1],meanlon,meanlat) > max:
+      if distance(p.lon,p.lat,meanlon,meanlat) > max:
          return False
    return True
 
-def outputkml(liste,fnm,maxdist,maxpics):
-   fnm = os.path.expanduser(fnm)
-   f = open(fnm,"w")
-   f.write( """<?xml version="1.0" encoding="UTF-8"?>
-<Document xmlns:xlink="http://www.w3/org/1999/xlink">
-   <name>picture pos</name>
-   <visibility>1</visibility>
-   <Folder>
-      <visibility>1</visibility>
-      <open>1</open>
-      <name>Photos</name>
-""")
-
+def groups(liste,maxdist):
+   """ cluster the time sorted point list, yields the point list of each group
+   """
    grouplist = []
    groupcnt = 0
    lonsum = 0
    latsum = 0
-   startname = None
-   endname = None
-   starttime = None
-   endtime = None
    
    for pos in liste:
 
       addtolist = False
       
       if groupcnt == 0:
-         startname = pos[4]
-         starttime = pos[0]
          addtolist = True
       else:
-         lonsum += pos[2]
-         latsum += pos[1]
-         dist = distance(pos[2],pos[1],lonsum / (groupcnt + 1),latsum / (groupcnt + 1))
+         lonsum += pos.lon
+         latsum += pos.lat
+         dist = distance(pos.lon,pos.lat,lonsum / (groupcnt + 1),latsum / (groupcnt + 1))
          if dist < maxdist:
             addtolist = True
             if groupcnt > 1:
@@ -222,48 +399,693 @@ def outputkml(liste,fnm,maxdist,maxpics):
                   addtolist = True
 
       if addtolist:
-         endname = pos[4]
-         endtime = pos[0]
          grouplist.append(pos)
          groupcnt += 1
       else:
-         outputgrouplist(f,grouplist,startname,starttime,endname,endtime,maxpics)
+         yield grouplist
          grouplist = []
-         startname = pos[4]
-         starttime = pos[0]
-         lonsum = pos[2]
-         latsum = pos[1]
+         lonsum = pos.lon
+         latsum = pos.lat
          grouplist.append(pos)
          groupcnt = 1
             
-   outputgrouplist(f,grouplist,startname,starttime,endname,endtime,maxpics)
+   if grouplist:
+      yield grouplist
+
+# Track simplification
+#
+# The track points (time, lon, lat, ele) are projected to a plane in
+# metres around the mean latitude, which is accurate enough for the
+# tolerances used here.
+
+def projecttrack(track):
+   """ (x, y) lists in metres of the track points """
+   radius = 6370000.0
+   tobog = math.pi / 180.0
+   lat0 = sum([p[2] for p in track]) / len(track)
+   fy = radius * tobog
+   fx = fy * math.cos(lat0 * tobog)
+   return ([p[1] * fx for p in track], [p[2] * fy for p in track])
+
+def simplifyvw(track,tolerance):
+   """ Visvalingam-Whyatt simplification, O(n log n)
+
+       points are removed in the order of the area of the triangle they
+       form with their neighbours while that area is below tolerance^2
+       (tolerance in metres), returns the list of remaining points
+   """
+   num = len(track)
+   if num < 3:
+      return list(track)
+
+   (xs,ys) = projecttrack(track)
+   limit = tolerance * tolerance
+   prev = range(-1,num - 1)
+   nxt = range(1,num + 1)
+   area = [None] * num
+
+   def triangle(i):
+      a = prev[i]
+      b = nxt[i]
+      return abs((xs[a] - xs[i]) * (ys[b] - ys[i]) - (xs[b] - xs[i]) * (ys[a] - ys[i])) / 2.0
+
+   heap = []
+   for i in xrange(1,num - 1):
+      area[i] = triangle(i)
+      heap.append((area[i],i))
+   heapq.heapify(heap)
+
+   keep = [True] * num
+   while heap:
+      (ar,i) = heapq.heappop(heap)
+      if not keep[i] or ar != area[i]:
+         continue                      # outdated heap entry
+      if ar >= limit:
+         break
+      keep[i] = False
+      a = prev[i]
+      b = nxt[i]
+      nxt[a] = b
+      prev[b] = a
+      # neighbours never get a smaller area than the point just removed
+      for j in (a,b):
+         if 0 < j < num - 1:
+            area[j] = max(triangle(j),ar)
+            heapq.heappush(heap,(area[j],j))
+
+   return [track[i] for i in xrange(num) if keep[i]]
+
+def simplifydp(track,tolerance):
+   """ Douglas-Peucker simplification
+
+       keeps every point farther than tolerance (metres) from the line
+       through the kept points, O(n log n) for ordinary tracks, O(n^2)
+       in the worst case
+   """
+   num = len(track)
+   if num < 3:
+      return list(track)
+
+   (xs,ys) = projecttrack(track)
+   keep = [False] * num
+   keep[0] = True
+   keep[num - 1] = True
+   stack = [(0,num - 1)]
+   while stack:
+      (a,b) = stack.pop()
+      dx = xs[b] - xs[a]
+      dy = ys[b] - ys[a]
+      length = math.hypot(dx,dy)
+      maxdist = -1.0
+      maxi = None
+      for i in xrange(a + 1,b):
+         if length > 0:
+            d = abs(dx * (ys[a] - ys[i]) - dy * (xs[a] - xs[i])) / length
+         else:
+            d = math.hypot(xs[i] - xs[a],ys[i] - ys[a])
+         if d > maxdist:
+            maxdist = d
+            maxi = i
+      if maxi != None and maxdist > tolerance:
+         keep[maxi] = True
+         stack.append((a,maxi))
+         stack.append((maxi,b))
+
+   return [track[i] for i in xrange(num) if keep[i]]
+
+simplifiers = {
+   "vw": simplifyvw,
+   "dp": simplifydp,
+}
+
+def trackmaxgap():
+   """ maxgap of the pos2exif configuration (seconds, 0: no limit) """
+   try:
+      conf = pos2exiflib.quickconfig(pos2exiflib.configfilename,"pos2exif",1,globelements = pos2exiflib.confelements)
+      maxgap = conf.glodata.get("maxgap")
+   except ValueError:
+      maxgap = None
+   if maxgap == None:
+      maxgap = pos2exiflib.confdefaults["maxgap"]
+   return maxgap
+
+def readsimplifiedtrack(fnm,method,tolerance,maxgap):
+   """ read a track file (any format pos2exif understands) and simplify it
+
+       returns a list of point lists, one for each time interval covered
+       by the track (see pos2exiflib.trackcoverage), each simplified on its own
+   """
+   segments = []
+   track = pos2exiflib.readTrack(fnm,segments)
+   track.sort()
+   if not track:
+      return []
+   coverage = pos2exiflib.trackcoverage(track,segments,maxgap)
+
+   pieces = []
+   i = -1
+   for p in track:
+      while i + 1 < len(coverage.starts) and coverage.starts[i + 1] <= p[0]:
+         i += 1
+         pieces.append([])
+      if i >= 0:
+         pieces[-1].append(p)
+
+   simple = [simplifiers[method](piece,tolerance) for piece in pieces]
+   num = sum([len(piece) for piece in simple])
+   print "Track: %s points in %s pieces, simplified to %s (%.1f%% less)" % (len(track),len(pieces),num,100.0 * (len(track) - num) / len(track))
+   return simple
+
+def outputtrack(dev,track):
+   """ write the track pieces as LineStrings of one MultiGeometry
+
+       the elevation is written only if all points have one
+   """
+   if not track:
+      return
+   withele = True
+   for piece in track:
+      for p in piece:
+         if p[3] == None:
+            withele = False
+            break
+   dev.write("<Placemark>\n<name>Track</name>\n<MultiGeometry>\n")
+   for piece in track:
+      if len(piece) < 2:
+         continue
+      dev.write("<LineString>\n<tessellate>1</tessellate>\n<coordinates>\n")
+      for p in piece:
+         if withele:
+            dev.write("%s,%s,%s\n" % (p[1],p[2],p[3]))
+         else:
+            dev.write("%s,%s\n" % (p[1],p[2]))
+      dev.write("</coordinates>\n</LineString>\n")
+   dev.write("</MultiGeometry>\n</Placemark>\n")
+
+class kmzfile:
+   """ file like object, writes a KMZ archive with doc.kml as first member
+
+       The data is deflated while it is written, so the uncompressed
+       document never exists on disk or in memory. Further members can be
+       added with addfile once the document is complete.
+   """
+
+   def __init__(self,filename,arcname = "doc.kml"):
+      self.f = open(filename,"wb")
+      self.members = []     # (arcname, crc, csize, usize, offset) for the central directory
+      self.comp = None
+
+      t = time.localtime()
+      self.dostime = (t[3] << 11) | (t[4] << 5) | (t[5] // 2)
+      self.dosdate = ((t[0] - 1980) << 9) | (t[1] << 5) | t[2]
+
+      self.startmember(arcname)
+
+   def startmember(self,arcname):
+      self.arcname = arcname
+      self.offset = self.f.tell()
+      self.crc = 0
+      self.usize = 0
+      self.csize = 0
+      self.comp = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,zlib.DEFLATED,-15)
+
+      # local file header, bit 3: sizes and CRC follow in the data descriptor
+      self.f.write(struct.pack("<IHHHHHIIIHH",0x04034b50,20,0x08,8,self.dostime,self.dosdate,0,0,0,len(arcname),0))
+      self.f.write(arcname)
+
+   def endmember(self):
+      data = self.comp.flush()
+      self.comp = None
+      self.csize += len(data)
+      self.f.write(data)
+      crc = self.crc & 0xffffffff
+      self.f.write(struct.pack("<IIII",0x08074b50,crc,self.csize,self.usize))
+      self.members.append((self.arcname,crc,self.csize,self.usize,self.offset))
+
+   def write(self,data):
+      self.crc = zlib.crc32(data,self.crc)
+      self.usize += len(data)
+      data = self.comp.compress(data)
+      self.csize += len(data)
+      self.f.write(data)
+
+   def addfile(self,arcname,fnm):
+      """ add the file fnm as member arcname, ends the current member
+      """
+      if self.comp:
+         self.endmember()
+      self.startmember(arcname)
+      f = open(fnm,"rb")
+      while True:
+         data = f.read(65536)
+         if not data:
+            break
+         self.write(data)
+      f.close()
+      self.endmember()
+
+   def close(self):
+      if self.comp:
+         self.endmember()
+
+      cdoffset = self.f.tell()
+      for (arcname,crc,csize,usize,offset) in self.members:
+         self.f.write(struct.pack("<IHHHHHHIIIHHHHHII",0x02014b50,20,20,0x08,8,self.dostime,self.dosdate,crc,csize,usize,len(arcname),0,0,0,0,0644 << 16,offset))
+         self.f.write(arcname)
+      cdsize = self.f.tell() - cdoffset
+      self.f.write(struct.pack("<IHHHHIIH",0x06054b50,0,0,len(self.members),len(self.members),cdsize,cdoffset,0))
+      self.f.close()
+
+def outputkml(liste,fnm,maxdist,maxpics,track = None,thumbnails = False):
+   """ write the groups of the time sorted point list (or iterator)
+
+       every placemark is written as soon as its group is complete,
+       a file name ending in .kmz gets a deflated KMZ archive,
+       track: optional list of track pieces (point lists) drawn as lines,
+       thumbnails: add the thumbnails of the images (KMZ only)
+   """
+   fnm = os.path.expanduser(fnm)
+   thumbs = None
+   if fnm.lower().endswith(".kmz"):
+      f = kmzfile(fnm)
+      if thumbnails:
+         thumbs = tempfile.TemporaryFile()
+   else:
+      f = open(fnm,"w")
+   f.write( """<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns:xlink="http://www.w3/org/1999/xlink">
+   <name>picture pos</name>
+   <visibility>1</visibility>
+   <Folder>
+      <visibility>1</visibility>
+      <open>1</open>
+      <name>Photos</name>
+""")
+
+   outputtrack(f,track)
+   for grouplist in groups(liste,maxdist):
+      outputgrouplist(f,grouplist,maxpics,thumbs)
 
    f.write("""   </Folder>
 </Document>
 """)
+   if thumbs:
+      thumbs.seek(0)
+      for arcname in thumbs:
+         f.addfile(arcname.strip(),thumbfile(arcname.strip()))
+      thumbs.close()
    f.close()
 
+# Sorting
+#
+# Up to sortchunk entries are collected in an imagetable and sorted in
+# memory. Larger inputs are sorted in chunks, which are written to
+# temporary files (one imagerecord.line per image) and merged again.
 
-cnt = 0
-imlist = []
-fnmlist = sys.argv[1:]
-for fnm in fnmlist:
-  print fnm
-  try:
-     po = getImageData(fnm)
-     cnt += 1
-  except ValueError:
-     po = None
-  if po:
-     imlist.append(po)
-  else:
-     print "No data"
+def spoolchunk(chunk):
+   f = tempfile.TemporaryFile()
+   for po in chunk:
+      f.write(po.line())
+   f.seek(0)
+   return f
 
-print "%s data points found" % (cnt,)
+def readspool(f):
+   """ yields the records of a spool or partial file, skips broken lines """
+   for line in f:
+      try:
+         yield parserecord(line)
+      except ValueError:
+         print "Warning: broken image record skipped:",line.strip()
+   f.close()
 
-print "Sorting list"
-imlist.sort()
+def sortedimages(images):
+   """ returns an iterator over the image data sorted by time
+   """
+   chunk = imagetable()
+   spools = []
+   for po in images:
+      chunk.append(po)
+      if len(chunk) >= sortchunk:
+         chunk.sort()
+         spools.append(spoolchunk(chunk))
+         chunk = imagetable()
+   chunk.sort()
+
+   if not spools:
+      return iter(chunk)
+   return heapq.merge(*([readspool(f) for f in spools] + [iter(chunk)]))
+
+def imagedata(args):
+   """ (fnm, image data or None, time for the thumbnail), runs in the worker processes
+
+       args: (fnm, thumbnails), with thumbnails the archive name of the
+       thumbnail is stored in the image data
+   """
+   (fnm,thumbnails) = args
+   try:
+      po = getImageData(fnm)
+   except ValueError:
+      return (fnm,None,0.0)
+   if not thumbnails:
+      return (fnm,po,0.0)
+   start = time.time()
+   po.thumb = getThumbnail(fnm)
+   return (fnm,po,time.time() - start)
+
+def writepartial(images,fnm):
+   """ write the sorted image data of a shard, see mergepartials
+   """
+   f = open(os.path.expanduser(fnm),"w")
+   for po in images:
+      f.write(po.line())
+   f.close()
+
+def mergepartials(fnmlist):
+   """ iterator over the image data of several partial files, sorted by time
+
+       The partial files are text files, one line per image (see
+       parserecord). The shards are split by file name, not by time, so
+       their images interleave and the merged stream is clustered again
+       as a whole.
+   """
+   return heapq.merge(*[readspool(open(os.path.expanduser(fnm))) for fnm in fnmlist])
 
-print "Writeing KML file"
+def readimages(fnmlist,counter,jobs = 1,thumbnails = False):
+   """ yields the image data of all files in fnmlist, counter[0] counts the images with data
 
-outputkml(imlist,"~/Desktop/pics.kml",maxradius,maxpics)
+       jobs > 1: read the data in a pool of jobs worker processes, the
+       results arrive in completion order,
+       thumbnails: extract the thumbnails, counter[1] sums up the time
+   """
+   args = itertools.izip(fnmlist,itertools.repeat(thumbnails))
+   pool = None
+   if jobs > 1:
+      pool = multiprocessing.Pool(jobs)
+      results = pool.imap_unordered(imagedata,args,16)
+   else:
+      results = itertools.imap(imagedata,args)
+
+   for (fnm,po,dt) in results:
+      print fnm
+      if po:
+         counter[0] += 1
+         if len(counter) > 1:
+            counter[1] += dt
+         yield po
+      else:
+         print "No data"
+
+   if pool:
+      pool.close()
+      pool.join()
+
+# Tiled output
+#
+# The groups are sorted into a quadtree over the whole globe, tile (z,x,y)
+# covers 360/2^z degrees of longitude and 180/2^z degrees of latitude.
+# Every group goes to its tile at depth tiledepth. Tiles with no more than
+# tilemaxpics groups become leaves holding the placemarks, larger tiles
+# show a single summary placemark and link to their sub-tiles via
+# NetworkLinks, which Google Earth loads only when the region is visible.
+
+def tilebox(z,x,y):
+   """ (north, south, east, west) of a tile """
+   n = 1 << z
+   return (90.0 - 180.0 * y / n, 90.0 - 180.0 * (y + 1) / n, -180.0 + 360.0 * (x + 1) / n, -180.0 + 360.0 * x / n)
+
+def tilename(z,x,y):
+   return "t%d_%d_%d.kml" % (z,x,y)
+
+def regionkml(z,x,y,minlod,maxlod):
+   return """<Region><LatLonAltBox><north>%s</north><south>%s</south><east>%s</east><west>%s</west></LatLonAltBox>
+<Lod><minLodPixels>%s</minLodPixels><maxLodPixels>%s</maxLodPixels></Lod></Region>
+""" % (tilebox(z,x,y) + (minlod,maxlod))
+
+def outputtiledkmz(liste,fnm,maxdist,maxpics,track = None,thumbnails = False):
+   """ write a KMZ file with a Region/Lod quadtree of the groups
+
+       The placemarks are spooled to one temporary file per tile at depth
+       tiledepth while the groups are built, only the tile statistics
+       are kept in memory.
+   """
+   fnm = os.path.expanduser(fnm)
+   tmp = tempfile.mkdtemp()
+   n = 1 << tiledepth
+   stats = {}          # leaf tile -> [groups, lonsum, latsum]
+   spoolkey = None
+   spool = None
+   thumbs = None
+   if thumbnails:
+      thumbs = tempfile.TemporaryFile()
+   
+   try:
+      for grouplist in groups(liste,maxdist):
+         (lon,lat,ele) = groupcenter(grouplist)
+         key = (min(int((lon + 180.0) / 360.0 * n),n - 1),min(int((90.0 - lat) / 180.0 * n),n - 1))
+         if key != spoolkey:
+            if spool:
+               spool.close()
+            spool = open(os.path.join(tmp,"%d_%d" % key),"a")
+            spoolkey = key
+         outputgrouplist(spool,grouplist,maxpics,thumbs)
+         st = stats.setdefault(key,[0,0.0,0.0])
+         st[0] += 1
+         st[1] += lon
+         st[2] += lat
+      if spool:
+         spool.close()
+
+      # sum up statistics for all levels of the quadtree
+      levels = [stats]
+      for z in range(tiledepth,0,-1):
+         upper = {}
+         for (x,y) in levels[0]:
+            st = levels[0][(x,y)]
+            up = upper.setdefault((x >> 1,y >> 1),[0,0.0,0.0])
+            up[0] += st[0]
+            up[1] += st[1]
+            up[2] += st[2]
+         levels.insert(0,upper)
+
+      zf = zipfile.ZipFile(fnm,"w",zipfile.ZIP_DEFLATED)
+      outputtile(zf,tmp,levels,0,0,0,"doc.kml",maxpics,track)
+      if thumbs:
+         thumbs.seek(0)
+         for arcname in thumbs:
+            zf.write(thumbfile(arcname.strip()),arcname.strip())
+      zf.close()
+   finally:
+      shutil.rmtree(tmp)
+
+def subtiles(levels,z,x,y):
+   """ existing sub-tiles of tile (z,x,y) """
+   return [c for c in ((2*x,2*y),(2*x+1,2*y),(2*x,2*y+1),(2*x+1,2*y+1)) if c in levels[z+1]]
+
+def leaftiles(levels,z,x,y):
+   """ spooled tiles at depth tiledepth below tile (z,x,y) """
+   if z == tiledepth:
+      return [(x,y)]
+   res = []
+   for (cx,cy) in subtiles(levels,z,x,y):
+      res.extend(leaftiles(levels,z+1,cx,cy))
+   return res
+
+def outputtile(zf,tmp,levels,z,x,y,arcname,maxpics,track = None):
+   st = levels[z].get((x,y),[0,0.0,0.0])
+   isleaf = z == tiledepth or st[0] <= tilemaxpics
+   tfnm = os.path.join(tmp,arcname)
+   f = open(tfnm,"w")
+   f.write("""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://earth.google.com/kml/2.1">
+<Document>
+<name>%s</name>
+""" % (arcname,))
+   outputtrack(f,track)
+
+   if isleaf:
+      # copy the placemarks of all spooled tiles below this one
+      for key in leaftiles(levels,z,x,y):
+         sf = open(os.path.join(tmp,"%d_%d" % key))
+         shutil.copyfileobj(sf,f)
+         sf.close()
+   else:
+      # summary placemark, hidden as soon as the sub-tiles are loaded
+      if z > 0:
+         f.write("<Folder>\n")
+         f.write(regionkml(z,x,y,0,256))
+         f.write("<Placemark>\n<name>%s pictures</name>\n" % (st[0],))
+         f.write("<Point><coordinates>%s,%s,0</coordinates></Point>\n</Placemark>\n</Folder>\n" % (st[1] / st[0],st[2] / st[0]))
+      for (cx,cy) in subtiles(levels,z,x,y):
+         f.write("<NetworkLink>\n<name>%s</name>\n" % (tilename(z+1,cx,cy),))
+         f.write(regionkml(z+1,cx,cy,128,-1))
+         f.write("<Link><href>%s</href><viewRefreshMode>onRegion</viewRefreshMode></Link>\n</NetworkLink>\n" % (tilename(z+1,cx,cy),))
+      
+   f.write("""</Document>
+</kml>
+""")
+   f.close()
+   zf.write(tfnm,arcname)
+   os.remove(tfnm)
+   
+   if not isleaf:
+      for (cx,cy) in subtiles(levels,z,x,y):
+         outputtile(zf,tmp,levels,z+1,cx,cy,tilename(z+1,cx,cy),maxpics)
+
+def usage():
+   print "exif2kml, version", version, "Copyright 2006, Michael Strecke"
+   print """exif2kml comes with ABSOLUTELY NO WARRANTY"
+
+usage: exif2kml [options] image ...
+       exif2kml --shard i/N [-o partfile] [-j n] image ...
+       exif2kml --merge [options] partfile ...
+
+options:
+-o, --output file  output file (default: ~/Desktop/pics.kml, or pics.kmz for tiled output)
+                   a file name ending in .kmz gets a compressed KMZ archive
+-t, --tiled        write a KMZ file with a Region/Lod quadtree of the placemarks
+                   instead of a flat KML file (for very large photo sets)
+--thumbnails       show the thumbnails embedded in the images in the placemarks
+                   (KMZ output only)
+--track file       add the track from a GPX (or NMEA, CSV) file as a line
+--simplify vw|dp   simplification of the track: Visvalingam-Whyatt (default)
+                   or Douglas-Peucker
+--tolerance m      tolerance of the track simplification in metres (default: %s)
+--maxgap s         split the track where two points are more than s seconds
+                   apart (0: no limit, default: maxgap of pos2exif)
+-j, --jobs n       read the image data with n worker processes
+--shard i/N        read only shard i of N of the images (split by a hash of the
+                   file name) and write their sorted data to a partial file
+                   (default: pics-iofN.part)
+--dedup            read identical images only once and count the duplicates
+                   (the duplicates are hashed completely to find them)
+--merge            the arguments are partial files of all shards, merge them
+                   and write the KML output. With --thumbnails the thumbnail
+                   caches (%s) of the hosts that read the shards
+                   must be copied to this host first.
+-h, --help         This message
+""" % (tracktolerance,thumbcache)
+
+if __name__ == "__main__":
+   try:
+      opts, fnmlist = getopt.getopt(sys.argv[1:],"o:tj:h",["output=","tiled","jobs=","shard=","merge","dedup","thumbnails","track=","simplify=","tolerance=","maxgap=","help"])
+   except getopt.GetoptError:
+      usage()
+      sys.exit(1)
+
+   tiled = False
+   output = None
+   trackfile = None
+   method = "vw"
+   tolerance = tracktolerance
+   maxgap = None
+   jobs = 1
+   shard = None
+   merge = False
+   dedup = False
+   thumbnails = False
+   for (o,a) in opts:
+      if o in ("-o","--output"):
+         output = a
+      if o in ("-t","--tiled"):
+         tiled = True
+      if o in ("-j","--jobs"):
+         try:
+            jobs = int(a)
+         except ValueError:
+            usage()
+            sys.exit(1)
+      if o == "--shard":
+         try:
+            shard = pos2exiflib.parseshard(a)
+         except ValueError:
+            usage()
+            sys.exit(1)
+      if o == "--merge":
+         merge = True
+      if o == "--dedup":
+         dedup = True
+      if o == "--thumbnails":
+         thumbnails = True
+      if o == "--track":
+         trackfile = a
+      if o == "--simplify":
+         method = a.lower()
+         if method not in simplifiers:
+            usage()
+            sys.exit(1)
+      if o == "--tolerance":
+         try:
+            tolerance = float(a)
+         except ValueError:
+            usage()
+            sys.exit(1)
+      if o == "--maxgap":
+         try:
+            maxgap = int(a)
+         except ValueError:
+            usage()
+            sys.exit(1)
+      if o in ("-h","--help"):
+         usage()
+         sys.exit(0)
+
+   if shard:
+      allfiles = len(fnmlist)
+      fnmlist = [fnm for fnm in fnmlist if pos2exiflib.inshard(fnm,shard)]
+      print "Shard %s/%s: %s of %s files" % (shard[0],shard[1],len(fnmlist),allfiles)
+
+   if thumbnails:
+      if not (tiled or shard or (output and output.lower().endswith(".kmz"))):
+         print "thumbnails need KMZ output (-o file.kmz or --tiled)"
+         sys.exit(1)
+      if not os.path.exists(os.path.expanduser(thumbcache)):
+         os.makedirs(os.path.expanduser(thumbcache))
+
+   if dedup and not merge:
+      print "Searching duplicates"
+      allfiles = len(fnmlist)
+      hashed = [0]
+      fnmlist = [group[0] for group in pos2exiflib.finddups(fnmlist,hashed)]
+      print "%s duplicates: %s exiftool runs saved, %.1f MB hashed" % (allfiles - len(fnmlist),allfiles - len(fnmlist),hashed[0] / 1048576.0)
+
+   if shard:
+      cnt = [0,0.0]
+      imlist = sortedimages(readimages(fnmlist,cnt,jobs,thumbnails))
+      print "%s data points found" % (cnt[0],)
+      if thumbnails and cnt[0]:
+         print "Thumbnails: %.1f ms per image" % (1000.0 * cnt[1] / cnt[0],)
+      if output == None:
+         output = "pics-%dof%d.part" % shard
+      print "Writing partial file:",output
+      writepartial(imlist,output)
+      sys.exit(0)
+
+   track = None
+   if trackfile:
+      print "Reading track file:",trackfile
+      if maxgap == None:
+         maxgap = trackmaxgap()
+      track = readsimplifiedtrack(trackfile,method,tolerance,maxgap)
+
+   if merge:
+      print "Merging %s partial files" % (len(fnmlist),)
+      imlist = mergepartials(fnmlist)
+   else:
+      cnt = [0,0.0]
+      print "Reading and sorting images"
+      imlist = sortedimages(readimages(fnmlist,cnt,jobs,thumbnails))
+
+      print "%s data points found" % (cnt[0],)
+      if thumbnails and cnt[0]:
+         print "Thumbnails: %.1f ms per image" % (1000.0 * cnt[1] / cnt[0],)
+
+   if tiled:
+      if output == None:
+         output = "~/Desktop/pics.kmz"
+      print "Writeing KMZ file"
+      outputtiledkmz(imlist,output,maxradius,maxpics,track,thumbnails)
+   else:
+      if output == None:
+         output = "~/Desktop/pics.kml"
+      print "Writeing KML file"
+      outputkml(imlist,output,maxradius,maxpics,track,thumbnails)
@@ -0,0 +1,1454 @@
+#
+# pos2exiflib - store GPS data in EXIF data field, the commands of pos2exif
+#
+# Copyright (C) 2006  Michael Strecke
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+import math, re, os, bisect, heapq, operator, struct
+import sys
+
+# the modules for XML, tracks, hashing and file copies are imported by the
+# functions that need them: the lightweight commands (help, gpstz, maxgap,
+# listsync, mergejournal) should start quickly
+
+debug = False
+
+version = "0.1"
+configfilename = "~/.pos2exif/pos2exif.conf"
+confdefaults = {"gpstimezone": None, "maxgap": 300}
+confelements = {"gpstimezone": int, "maxgap": int}
+dedupblock = 65536     # size of the blocks hashed for the duplicate fingerprint
+
+# error constants
+
+ERR_TIME_ZONE_NOT_SET = 1
+ERR_GPX_FORMAT_INVALID = 2
+ERR_NOT_ENOUGH_PARAMETERS = 3
+ERR_TIME_ZONE_INVALID = 4
+ERR_SYNC_TIME_FORMAT_INVALID = 5
+ERR_SHARD_INVALID = 6
+
+
+
+# Convert functions
+
+def decodetime(s):
+   import datetime
+   # 2006-07-07T10:20:56Z
+   erg = re.match("^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})Z$",s)
+   if erg:
+      return datetime.datetime(int(erg.group(1)),int(erg.group(2)),int(erg.group(3)),int(erg.group(4)),int(erg.group(5)),int(erg.group(6)))   
+
+   # 2006:07:07 17:06:38 or 2006.07.07 17:06:38 or 2006-07-07 17:06:38
+   # JJJJ:MM:DD HH:MM:SS
+   erg = re.match("^(\d{4})[:|.|-](\d{2})[:|.|-](\d{2}) (\d{2}):(\d{2}):(\d{2})$",s)
+   if erg:
+      return datetime.datetime(int(erg.group(1)),int(erg.group(2)),int(erg.group(3)),int(erg.group(4)),int(erg.group(5)),int(erg.group(6)))   
+
+   raise ValueError,"Unknow date format: "+s
+
+# XML helper functions
+
+def appendNodeAndText(doc,parent,element,content):
+   """ append an element node with corresponding text node to parent
+   
+       doc:     document
+       parent:  parent node to which the child will be appended
+       element: name of the text node
+       content: content of the text node (None -> empty node)
+   """
+   s = doc.createElement(element)
+   if content != None:
+      t = doc.createTextNode(str(content))
+      s.appendChild(t)
+   parent.appendChild(s)
+
+def getChildValue(node,childname):
+   """ get value of child of node with name childname
+   
+       return value
+         None: if node exists but no text node
+       raises ValueError if child does not exist
+   """ 
+   import xml.dom.minidom
+   for ele in node.childNodes:
+      if ele.nodeType == xml.dom.minidom.Node.ELEMENT_NODE:
+         if childname == ele.localName:
+            value = None
+            for sub in ele.childNodes:
+               if sub.nodeType == xml.dom.minidom.Node.TEXT_NODE:
+                  return sub.nodeValue
+            return value
+   raise ValueError, "no such child"
+
+def setChildValue(doc,node,childname,value):
+   import xml.dom.minidom
+   found = False
+   for ele in node.childNodes:
+      if ele.nodeType == xml.dom.minidom.Node.ELEMENT_NODE:
+         if childname == ele.localName:
+            # search child of element node for text nodes
+            for sub in ele.childNodes:
+               if sub.nodeType == xml.dom.minidom.Node.TEXT_NODE:
+                  found = True
+                  if value != None:
+                     # set new value, if not None
+                     sub.nodeValue = str(value)
+                  else:
+                     # remove text node, if new value *is* None
+                     ele.removeChild(sub)
+                  return
+            
+            # element node has no text child nodes
+            if not found:
+               # add one, if value is not None
+               if value != None:
+                  sub = doc.createTextNode(str(value))
+                  ele.appendChild(sub)
+            return
+   
+   # No element node with that name found
+   if not found:            
+      appendNodeAndText(doc,node,childname,value)
+
+class config:
+
+   def __init__(self,filename,rootnodename,version,defaults=None,globelements=None):
+      import xml.dom.minidom
+   
+      if globelements == None:
+         globelements = {}
+         
+      self.doc = None              # pointer to xml doc in memory
+      self.root = None             # pointer to root element
+      self.glodata = {}
+      self.globelements = globelements
+      self.filename = filename     # we need that when we write the tree to disk
+
+      filename = os.path.expanduser(filename)
+      try:
+         # try to parse file
+         self.doc = xml.dom.minidom.parse(filename)  
+      except:
+         # Create default tree
+         self.doc = xml.dom.minidom.Document()    # empty tree
+         self.root = self.doc.createElement(rootnodename)
+         self.doc.appendChild(self.root)
+         self.root.setAttribute("version",str(version))
+    
+      # Now scan the (newly created or read) tree
+      # throw exeception, if root element of XML files is not the one we expect
+      
+      self.root = self.doc.getElementsByTagName(rootnodename)
+      assert self.root != None
+      self.root = self.root[0]    # As this is the root element, only one can be available
+
+      # check data version
+      v = self.root.getAttribute("version")
+      if (v != None) and (int(v) != version):
+         raise ValueError,"data version not compatible"
+
+      # populate sub-tree with defaults, if nodes are not already present
+      if defaults:
+         self.dict2tree(defaults, overwrite = False)
+      # fill local dictionary with (merged) data from the tree
+      self.glodata = self.tree2dict(globelements)
+
+      if debug:
+         print self.glodata
+       
+   def dict2tree(self,di, overwrite):
+      if not di:
+         return
+         
+      for key in di:
+         nodelist = self.root.getElementsByTagName(key)
+         nodecnt = len(nodelist)
+         if nodecnt == 0:
+             setChildValue(self.doc,self.root,key,di[key])
+         elif nodecnt == 1:
+             if overwrite:
+                setChildValue(self.doc,self.root,key,di[key])
+         else:
+             raise ValueError,"unique key found more than once"
+             
+   def tree2dict(self,nodes):
+      if not nodes:
+         return {}
+       
+      di = {}
+      for nodename in nodes:
+         nodelist = self.root.getElementsByTagName(nodename)
+         nodecnt = len(nodelist)
+         if nodecnt == 1:
+             val = getChildValue(self.root,nodename)  # remember, values are always strings!
+             if val != None:
+                if nodes[nodename] != None:           # use supplied conversion function
+                   di[nodename] = nodes[nodename](val)
+                else:
+                   di[nodename] = val
+             else:                                    # None remains None, regardless of the conversion function
+                di[nodename] = None
+                
+         elif nodecnt == 0:
+             pass
+         else:
+             raise ValueError,"unique key found more than once"
+      return di
+     
+             
+   def writedata(self,filename = None):
+      assert self.doc != None
+      out = filename
+      if out == None:
+         out = self.filename
+      assert out != None
+      
+      out = os.path.expanduser(out)
+
+      # create subdir, if necessary
+      pa = os.path.split(out)[0]           # dir part
+      if pa:
+        if not os.path.exists(pa):
+            os.makedirs(pa)
+      
+      # merge local dictionary into XML tree
+      self.dict2tree(self.glodata, overwrite = True)
+      if debug:
+         print self.doc.toxml()
+      fl = open(out,"w")
+      fl.write(self.doc.toxml())     
+#      xml.dom.ext.PrettyPrint(self.doc,fl)
+      fl.close()
+
+   def setsync(self,model,dif,time):
+      found = False
+      tzs = self.root.getElementsByTagName("syncoffset")
+      for ele in tzs:
+         mod = ele.getAttribute("model")
+         if mod == model:
+            found = True
+            setChildValue(self.doc,ele,"diff",dif)
+            setChildValue(self.doc,ele,"time",time)
+            break
+      
+      if not found:
+         ele = self.doc.createElement("syncoffset")
+         ele.setAttribute("model",model)
+         self.root.appendChild(ele)
+         setChildValue(self.doc,ele,"diff",dif)
+         setChildValue(self.doc,ele,"time",time)
+         Found = True
+         
+      print "sync offset for %s set to %s" % (model,dif)
+         
+   def getsync(self,model):
+      found = False
+      tzs = self.root.getElementsByTagName("syncoffset")
+      for ele in tzs:
+         mod = ele.getAttribute("model")
+         if mod == model:
+            found = True
+            dif = int(getChildValue(ele,"diff"))
+            time = decodetime(getChildValue(ele,"time"))
+            return {"diff": dif, "time":time}
+      return None
+
+   def listsync(self):
+      tzs = self.root.getElementsByTagName("syncoffset")
+      first = True
+      for ele in tzs:
+         mod = ele.getAttribute("model")
+         diff = int(getChildValue(ele,"diff"))
+         time = getChildValue(ele,"time")
+         
+         if first:
+            print "Model                Offset   date"
+         first = False
+         
+         print "%20s: %5d %s" % (mod,diff,time)
+         
+      if first:         
+         print "no entries found"
+               
+def xmlunescape(s):
+   return s.replace("&lt;","<").replace("&gt;",">").replace("&quot;",'"').replace("&amp;","&")
+
+def xmlescape(s):
+   return s.replace("&","&amp;").replace("<","&lt;").replace(">","&gt;").replace('"',"&quot;")
+
+class quickconfig:
+   """ fast access to the config file for the lightweight commands
+
+       config.writedata writes a flat document: the global values are
+       <name>value</name> children of the root element, the sync offsets
+       <syncoffset model="..."> elements. quickconfig reads and changes
+       these with regular expressions instead of building a DOM. It raises
+       ValueError if the file looks different, use config then.
+   """
+
+   def __init__(self,filename,rootnodename,version,globelements=None):
+      if globelements == None:
+         globelements = {}
+      self.filename = filename
+      self.rootnodename = rootnodename
+      self.glodata = {}
+
+      try:
+         f = open(os.path.expanduser(filename))
+         self.text = f.read()
+         f.close()
+      except IOError:
+         self.text = '<?xml version="1.0" ?><%s version="%s"/>' % (rootnodename,version)
+
+      m = re.search('<%s version="(\d+)"\s*(/?)>' % (rootnodename,),self.text)
+      if not m:
+         raise ValueError,"unknown config format"
+      if int(m.group(1)) != version:
+         raise ValueError,"data version not compatible"
+      if m.group(2):
+         # empty root element
+         self.text = self.text[:m.start()] + '<%s version="%s"></%s>' % (rootnodename,version,rootnodename) + self.text[m.end():]
+      if self.text.count("</%s>" % (rootnodename,)) != 1:
+         raise ValueError,"unknown config format"
+
+      for name in globelements:
+         found = re.findall("<%s>([^<]*)</%s>|<%s/>" % (name,name,name),self.text)
+         if len(found) == 1:
+            if found[0]:
+               val = xmlunescape(found[0])
+               if globelements[name] != None:
+                  val = globelements[name](val)
+               self.glodata[name] = val
+            else:
+               self.glodata[name] = None
+         elif len(found) > 1:
+            raise ValueError,"unique key found more than once"
+
+   def writedata(self):
+      for name in self.glodata:
+         if self.glodata[name] != None:
+            ele = "<%s>%s</%s>" % (name,xmlescape(str(self.glodata[name])),name)
+         else:
+            ele = "<%s/>" % (name,)
+         (self.text,n) = re.subn("<%s>[^<]*</%s>|<%s/>" % (name,name,name),ele,self.text)
+         if n == 0:
+            self.text = self.text.replace("</%s>" % (self.rootnodename,),ele + "</%s>" % (self.rootnodename,))
+
+      out = os.path.expanduser(self.filename)
+      pa = os.path.split(out)[0]
+      if pa:
+        if not os.path.exists(pa):
+            os.makedirs(pa)
+      fl = open(out,"w")
+      fl.write(self.text)
+      fl.close()
+
+   def listsync(self):
+      first = True
+      for (mod,body) in re.findall('<syncoffset model="([^"]*)">(.*?)</syncoffset>',self.text,re.S):
+         diff = int(re.search("<diff>([^<]*)</diff>",body).group(1))
+         time = re.search("<time>([^<]*)</time>",body).group(1)
+
+         if first:
+            print "Model                Offset   date"
+         first = False
+         
+         print "%20s: %5d %s" % (xmlunescape(mod),diff,xmlunescape(time))
+         
+      if first:         
+         print "no entries found"
+
+def distance(longS, latS, longD, latD):
+   # http://obivan.uni-trier.de/p/h/vb/third_b_va.html
+   radius = 6370000.0
+   tobog = math.pi / 180.0
+   dl = abs(longS - longD) * tobog
+   
+   latS *= tobog
+   latD *= tobog
+   
+   cos_d = math.sin(latS) * math.sin(latD) + math.cos(latS) * math.cos(latD) * math.cos(dl)
+   dist = math.acos(cos_d) * radius 
+   
+   return dist
+
+
+def decodearg(s):
+   return float(s)
+   
+
+def getTrackPoints(fnm,segments = None):
+   """ read track points from a GPX file
+
+       segments: if a list is given, the (first, last) time of every
+       track segment is appended to it
+   """
+   import xml.dom.minidom
+   doc = xml.dom.minidom.parse(fnm)
+   root = doc.getElementsByTagName("gpx")[0]
+   tracks = root.getElementsByTagName("trk")
+
+   allpoints = []
+   lastlon = None
+   tlast = None
+   for track in tracks:
+      tracksegments = track.getElementsByTagName("trkseg")
+      for segment in tracksegments:
+         first = True
+         segstart = None
+         segend = None
+         trackpoints = segment.getElementsByTagName("trkpt")
+         for point in trackpoints:
+
+            # skip frist point of every 
+            if not first:
+               lon = float(point.getAttribute("lon"))
+               lat = float(point.getAttribute("lat"))
+               try:
+                  ele = getChildValue(point,"ele")
+                  ele = float(ele)
+               except ValueError:
+                  ele = None
+               try:
+                  timest = getChildValue(point,"time")
+               except ValueError:
+                  timest = None
+                        
+               if timest:
+                  tnow = decodetime(timest)
+                  allpoints.append((tnow,lon,lat,ele))
+                  if segstart == None or tnow < segstart:
+                     segstart = tnow
+                  if segend == None or tnow > segend:
+                     segend = tnow
+               else:
+                  tnow = None
+            first = False
+
+         if segments != None and segstart != None:
+            segments.append((segstart,segend))
+   
+   return allpoints
+
+def decodenmeapos(value,hemi):
+   # ddmm.mmmm / dddmm.mmmm -> decimal degrees
+   dot = value.find(".")
+   if dot < 0:
+      dot = len(value)
+   pos = int(value[:dot-2]) + float(value[dot-2:]) / 60.0
+   if hemi == "S" or hemi == "W":
+      pos = -pos
+   return pos
+
+def nmeachecksum(body):
+   """ XOR of the characters between $ and * of an NMEA sentence """
+   # XOR 8 characters at a time, then fold the 64 bit word to one byte
+   body += "\0" * (-len(body) % 8)
+   x = reduce(operator.xor,struct.unpack("<%dQ" % (len(body) // 8,),body),0)
+   x ^= x >> 32
+   x ^= x >> 16
+   x ^= x >> 8
+   return x & 0xff
+
+def getTrackPointsNMEA(fnm):
+   """ read track points from a raw NMEA log ($GPRMC and $GPGGA sentences,
+       $GNRMC and $GNGGA of multi-GNSS receivers)
+
+       RMC supplies date, time and position, GGA the elevation. Sentences
+       with the same time stamp are merged into one point. Sentences with
+       a wrong checksum are skipped, sentences without one are accepted.
+   """
+   import datetime
+   allpoints = []
+   day = None          # (year, month, day) from the last valid RMC sentence
+   curtime = None      # time field of the fix being collected
+   lon = None
+   lat = None
+   ele = None
+
+   f = open(fnm)
+   for line in f:
+      if line[:3] != "$GP" and line[:3] != "$GN":
+         continue
+      typ = line[3:6]
+      if typ != "RMC" and typ != "GGA":
+         continue
+      star = line.find("*")
+      if star > 0:
+         try:
+            if int(line[star+1:star+3],16) != nmeachecksum(line[1:star]):
+               continue
+         except ValueError:
+            continue
+         line = line[:star]
+      fields = line.split(",")
+      try:
+         if fields[1] != curtime:
+            # new fix begins, store the previous one
+            if day and lon != None:
+               allpoints.append((datetime.datetime(day[0],day[1],day[2],int(curtime[0:2]),int(curtime[2:4]),int(curtime[4:6])),lon,lat,ele))
+            curtime = fields[1]
+            lon = None
+            lat = None
+            ele = None
+
+         if typ == "RMC":
+            if fields[2] != "A":         # A: valid fix, V: warning
+               continue
+            d = fields[9]
+            year = int(d[4:6])
+            if year < 80:
+               year += 2000
+            else:
+               year += 1900
+            day = (year,int(d[2:4]),int(d[0:2]))
+            lat = decodenmeapos(fields[3],fields[4])
+            lon = decodenmeapos(fields[5],fields[6])
+         else:
+            if fields[6] == "0":         # fix quality 0: invalid
+               continue
+            if lon == None:
+               lat = decodenmeapos(fields[2],fields[3])
+               lon = decodenmeapos(fields[4],fields[5])
+            if fields[9]:
+               ele = float(fields[9])
+      except (ValueError, IndexError):
+         # garbled sentence, skip it
+         continue
+   f.close()
+
+   if day and lon != None:
+      allpoints.append((datetime.datetime(day[0],day[1],day[2],int(curtime[0:2]),int(curtime[2:4]),int(curtime[4:6])),lon,lat,ele))
+
+   return allpoints
+
+csvcolumns = {
+   "time": ("time","timestamp","datetime","utc"),
+   "date": ("date",),
+   "lon":  ("lon","lng","long","longitude"),
+   "lat":  ("lat","latitude"),
+   "ele":  ("ele","alt","altitude","elevation","height"),
+}
+
+def getTrackPointsCSV(fnm):
+   """ read track points from a CSV file with a header line
+
+       the columns are found by name (see csvcolumns), the time is either
+       one column or split into a date and a time column. Comma and
+       semicolon are accepted as separator.
+   """
+   import csv
+   f = open(fnm)
+   header = f.readline()
+   if header.count(";") > header.count(","):
+      sep = ";"
+   else:
+      sep = ","
+
+   col = {}
+   names = [n.strip().strip('"').lower() for n in header.split(sep)]
+   for key in csvcolumns:
+      for i in range(len(names)):
+         if names[i] in csvcolumns[key]:
+            col[key] = i
+            break
+
+   if not ("lon" in col and "lat" in col and "time" in col):
+      f.close()
+      raise ValueError, "CSV header does not name time, lat and lon columns"
+
+   ti = col["time"]
+   di = col.get("date")
+   loi = col["lon"]
+   lai = col["lat"]
+   eli = col.get("ele")
+
+   allpoints = []
+   for row in csv.reader(f, delimiter = sep):
+      try:
+         if di != None:
+            tnow = decodetime(row[di] + " " + row[ti])
+         else:
+            tnow = decodetime(row[ti])
+         lon = float(row[loi])
+         lat = float(row[lai])
+         ele = None
+         if eli != None and row[eli]:
+            ele = float(row[eli])
+      except (ValueError, IndexError):
+         continue
+      allpoints.append((tnow,lon,lat,ele))
+   f.close()
+
+   return allpoints
+
+def readTrack(fnm,segments = None):
+   """ read track points, the file format is derived from the file extension
+
+       .nmea, .log: NMEA log
+       .csv:        CSV file
+       else:        GPX file (segments: see getTrackPoints)
+   """
+   ext = os.path.splitext(fnm)[1].lower()
+   if ext == ".nmea" or ext == ".log":
+      return getTrackPointsNMEA(fnm)
+   if ext == ".csv":
+      return getTrackPointsCSV(fnm)
+   return getTrackPoints(fnm,segments)
+
+def storeImageTag(retval,tag,value):
+   """ store an exiftool tag line in the image data dictionary """
+   if tag == "CreateDate":
+      retval["date"] = decodetime(value)
+   if tag == "Model":
+      retval["model"] = value
+   if tag == "GPSLongitude":
+      retval["gpslon"] = value
+
+def getImageData(fnm):
+   # TODO: sanatize fnm
+   cmd = "exiftool -e -S -CreateDate -Model -GPSLongitude " + fnm
+   pipe = os.popen(cmd)
+   res = pipe.read()
+   errno = pipe.close()
+   
+   retval = None
+   
+   if errno == None:
+      retval = {}
+      resl = res.splitlines()
+      for line in resl:
+         wp = line.split(":",1)
+         storeImageTag(retval,wp[0],wp[1].strip())
+            
+   # check, if we have a valid data set
+   # in case of an "Image Format Error", exiftool does NOT return an error code 
+   
+   try:
+      x = retval["date"]
+      x = retval["model"]
+   except KeyError:
+      retval = None
+      
+   return retval
+
+def getImageDataBatch(fnmlist):
+   """ read the image data of many files with a single exiftool call
+
+       returns a dictionary file name -> image data (see getImageData),
+       files without valid data are missing
+   """
+   import tempfile
+   # the file names are passed in an argument file: no shell quoting,
+   # no limit of the command line length
+   argf = tempfile.NamedTemporaryFile(suffix = ".args")
+   for fnm in fnmlist:
+      argf.write(fnm + "\n")
+   argf.flush()
+   cmd = "exiftool -e -S -CreateDate -Model -GPSLongitude -@ \"%s\"" % (argf.name,)
+   pipe = os.popen(cmd)
+   res = pipe.read()
+   pipe.close()        # not 0 if some files failed, these have no data below
+   argf.close()
+
+   data = {}
+   cur = None
+   if len(fnmlist) == 1:
+      # exiftool prints the "======== file" header for several files only
+      cur = {}
+      data[fnmlist[0]] = cur
+   for line in res.splitlines():
+      if line.startswith("======== "):
+         cur = {}
+         data[line[9:]] = cur
+         continue
+      wp = line.split(":",1)
+      if cur == None or len(wp) < 2:
+         continue
+      try:
+         storeImageTag(cur,wp[0],wp[1].strip())
+      except ValueError:
+         pass
+
+   retval = {}
+   for fnm in data:
+      if "date" in data[fnm] and "model" in data[fnm]:
+         retval[fnm] = data[fnm]
+   return retval
+
+def syncoffset(imgtime,rdouttime):
+   """ seconds to add to the camera time imgtime to get the GPS time rdouttime """
+   td = rdouttime - imgtime
+   return td.days * 86400 + td.seconds
+
+def median(values):
+   values = sorted(values)
+   num = len(values)
+   if num % 2:
+      return values[num // 2]
+   return int(round((values[num // 2 - 1] + values[num // 2]) / 2.0))
+
+def sync(fnm,rdouttime):
+   imdata = getImageData(fnm)
+
+   if debug:   
+      print "Time in picture",imdata["date"], "Time in read-out:", rdouttime
+   dif = syncoffset(imdata["date"],rdouttime)
+         
+   res = {"model": imdata["model"], "diff": dif, "date": imdata["date"]}   
+   
+   if debug:
+      print "Sync result:", res
+   return res
+
+def searchTrack(reftrack,time):
+   """ binary search for the indices (low, top) of the track points around time
+   """
+   maxpoi = len(reftrack)
+   
+   # binary search
+   low = 0
+   top = maxpoi -1
+   
+   while True:
+     
+     test = (top+low) / 2
+     if test == top:
+        break
+     
+     if debug:
+        print
+        print "dest:", time
+        print "Low: ",low, reftrack[low][0]
+        print "High: ",top, reftrack[top][0]
+        print "test: ",test, reftrack[test][0]
+        print "test+1: ",test+1, reftrack[test+1][0]
+     
+     if reftrack[test][0] == time:
+        low = test
+        top = test
+        break
+     
+     if reftrack[test+1][0] == time:
+        low = test+1
+        top = test+1
+        break
+
+     if (reftrack[test][0] < time) and (time < reftrack[test+1][0]):
+        low = test
+        top = test+1
+        break
+
+     if reftrack[test][0] < time:
+        low = test
+        continue
+
+     if reftrack[test][0] > time:
+        top = test
+        continue
+       
+
+   return (low,top)
+
+def tdseconds(td):
+   return td.days * 86400 + td.seconds + td.microseconds / 1000000.0
+
+class trackindex:
+   """ uniform time bucket index over a sorted track
+
+       The time span of the track is divided into buckets of the mean
+       sampling interval, each bucket stores the index of its first track
+       point. For loggers with a (nearly) constant rate a lookup is a
+       division and a bisect over very few points.
+   """
+
+   def __init__(self,reftrack):
+      self.t0 = reftrack[0][0]
+      self.secs = [tdseconds(p[0] - self.t0) for p in reftrack]
+      num = len(self.secs)
+      span = self.secs[num-1]
+      if span > 0 and num > 1:
+         self.width = span / (num - 1)
+      else:
+         self.width = 1.0
+
+      # a point belongs to the bucket given by the same division find()
+      # uses, rounding must not move the last point past the last bucket
+      self.last = int(span / self.width)
+      self.buckets = []
+      i = 0
+      for b in xrange(self.last + 2):
+         while i < num and min(int(self.secs[i] / self.width),self.last) < b:
+            i += 1
+         self.buckets.append(i)
+
+   def find(self,time):
+      """ indices (low, top) of the track points around time
+
+          low == top for an exact match, None if time is outside the track
+      """
+      s = tdseconds(time - self.t0)
+      secs = self.secs
+      num = len(secs)
+      if s < 0 or s > secs[num-1]:
+         return None
+      b = min(int(s / self.width),self.last)
+      i = bisect.bisect_left(secs,s,self.buckets[b],self.buckets[b+1])
+      i = min(i,num-1)
+      if secs[i] == s:
+         return (i,i)
+      return (i-1,i)
+
+class trackcoverage:
+   """ sorted time intervals covered by a track
+
+       The track is split at segment boundaries (GPX trkseg) and wherever
+       two neighbouring points are more than maxgap seconds apart (logger
+       switched off, no fix). Overlapping intervals are merged. Times
+       outside all intervals must not be interpolated.
+   """
+
+   def __init__(self,reftrack,segments = None,maxgap = 0):
+      import datetime
+      if not segments:
+         segments = [(reftrack[0][0],reftrack[len(reftrack)-1][0])]
+
+      gaps = []
+      if maxgap:
+         limit = datetime.timedelta(seconds = maxgap)
+         for i in xrange(1,len(reftrack)):
+            if reftrack[i][0] - reftrack[i-1][0] > limit:
+               gaps.append((reftrack[i-1][0],reftrack[i][0]))
+      gapstarts = [g[0] for g in gaps]
+
+      # cut the segments at the gaps
+      pieces = []
+      for (start,end) in segments:
+         i = bisect.bisect_left(gapstarts,start)
+         while i < len(gaps) and gaps[i][1] <= end:
+            pieces.append((start,gaps[i][0]))
+            start = gaps[i][1]
+            i += 1
+         pieces.append((start,end))
+      pieces.sort()
+
+      self.starts = []
+      self.ends = []
+      for (start,end) in pieces:
+         if self.ends and start <= self.ends[-1]:
+            self.ends[-1] = max(self.ends[-1],end)
+         else:
+            self.starts.append(start)
+            self.ends.append(end)
+
+   def covers(self,time):
+      """ True if time lies in one of the intervals, O(log intervals) """
+      i = bisect.bisect_right(self.starts,time) - 1
+      return i >= 0 and time <= self.ends[i]
+
+def lookupTrack(reftrack,time,index = None):
+   """ position at time, interpolated between the neighbouring track points
+
+       index: optional trackindex of reftrack, replaces the binary search
+   """
+
+   maxpoi = len(reftrack)     # 0: time, 1: lon, 2: lat, 3: ele
+   
+   if time < reftrack[0][0]:
+      return None
+      
+   if time > reftrack[maxpoi-1][0]:
+      return None
+      
+   mode = 0
+   if index != None:
+      (low,top) = index.find(time)
+   else:
+      (low,top) = searchTrack(reftrack,time)
+
+   if debug:
+      print "Ergebnis: ", mode, low, top
+      
+   plow = reftrack[low]
+   phigh = reftrack[top]
+   if low == top:
+      return plow
+   
+   # segment breaks and gaps longer than maxgap are rejected before the
+   # lookup (trackcoverage, see getPosition), points without elevation
+   # give a position without elevation
+
+   dtp = tdseconds(phigh[0] - plow[0])
+
+   if dtp == 0:
+      return plow
+  
+   dt = tdseconds(time - plow[0])
+
+  
+   mlon = (phigh[1] - plow[1]) * dt / dtp + plow[1]
+   mlat = (phigh[2] - plow[2]) * dt / dtp + plow[2]
+   if phigh[3] != None and plow[3] != None:
+      mele = (phigh[3] - plow[3]) * dt / dtp + plow[3]
+   else:
+      mele = None
+
+   mpoi = (time,mlon,mlat,mele)
+   if debug:
+      print "A: ",plow
+      print "B: ",phigh
+      print "M: ",mpoi
+      print "Distance A/B",distance(plow[1],plow[2],phigh[1],phigh[2])
+      print "time dif A/B",dtp
+      print "time dif A/M",dt
+   
+   return mpoi     
+
+def getPosition(track, fnm, gpsoverwrite = False, index = None, coverage = None):
+   global conf
+   import datetime
+
+   imgval = getImageData(fnm)
+   if imgval == None:
+      print "no exif data found"
+      return None
+      
+   if not gpsoverwrite:
+      try:
+         x = imgval["gpslon"]
+         print "image already contains GPS data"
+         return None
+      except KeyError:
+         pass
+   imgtime = imgval["date"]
+   syncdata = conf.getsync(imgval["model"])
+   if syncdata == None:
+      print "no sync datat for model %s" %(imgval["model"],)
+      return None
+      
+   imgsync = syncdata["diff"]
+   syncage = abs(imgtime - syncdata["time"])
+   
+   if debug: 
+      print "Image time",imgtime
+      print "Sync diff",imgsync
+      print "Syncage (days)", syncage.days
+      print conf.glodata
+      
+   if syncage.days > 30:
+      print "Warning: time difference to clock sync: %s days" % (syncage.days,)
+      
+   dt = datetime.timedelta(hours = -conf.glodata["gpstimezone"], seconds = imgsync)
+   corrtime = imgtime + dt
+   if coverage != None and not coverage.covers(corrtime):
+      print "Image time %s (GPS) not covered by the track" % (corrtime,)
+      return None
+   po = lookupTrack(track, corrtime, index)
+   if po == None:
+      print "No suitable point found"
+   return po
+   
+def setPosition(fnm,pos):
+   lon = pos[1]
+   lat = pos[2]
+   alt = pos[3]
+   
+   if lon >= 0:
+      lonR = "E"
+   else:
+      lonR = "W"
+      lon = -lon
+   
+   if lat >= 0:
+      latR = "N"
+   else:
+      latR = "S"
+      lat = -lat
+   
+   # -P = preserve file date
+   # -overwrite_original
+   cmd = "exiftool -P -GPSLongitude=\"%s\" -GPSLongitudeRef=\"%s\" -GPSLatitude=\"%s\" -GPSLatitudeRef=\"%s\"" % (lon,lonR,lat,latR)
+   if alt != None:
+      if alt >= 0:
+         altR = "Above Sea Level"
+      else:
+         altR = "Below Sea Level"
+         alt = -alt
+      cmd += " -GPSAltitude=\"%s\" -GPSAltitudeRef=\"%s\"" % (alt,altR)
+   
+   cmd += " \"%s\"" % (fnm,)
+
+   if debug:
+      print cmd
+   
+   pipe = os.popen(cmd)
+   res = pipe.read()
+   errno = pipe.close()
+
+   return (errno,res)
+
+   
+def preflightcheck():
+   notz = True
+   try:
+      tz = conf.glodata["gpstimezone"]
+      if tz != None:
+         notz = False
+   except KeyError:
+      pass
+   if notz:
+      print """time zone of the GPS receiver not set.
+use 
+   pos2exif gpstz #
+"""
+      sys.exit(ERR_TIME_ZONE_NOT_SET)
+          
+
+def usage():
+   print "pos2exif, version", version, "Copyright 2006, Michael Strecke"
+   print """"pos2exif comes with ABSOLUTELY NO WARRANTY"
+
+Available commands:
+
+gpstz #                               set time zone used in GPS receiver display (numerical value)
+maxgap #                              max. time between two track points (seconds) that is
+                                      interpolated, longer gaps split the track (0: no limit)
+sync filename JJJJ.MM.TT HH:MM:SS     determine time difference between GPS clock and the clock in digital camera
+syncbatch manifest                    determine the sync offsets of several cameras at once,
+                                      manifest lines: filename JJJJ.MM.TT HH:MM:SS
+listsync                              display all sync data
+gpstag trackfile image                store GPS data derived from track in .GPX file in the EXIF data of the image
+                                      (NMEA logs: .nmea or .log, CSV files with header line: .csv)
+gpstagovr trackfile filename          same as "gpstag", but overwrites existing GPS data
+mergejournal outfile journal ...      merge the journals of several shards
+help                                  This message
+
+gpstag and gpstagovr accept "--shard i/N": process only shard i of N of the
+images (split by a hash of the file name) and write the tagged positions to
+the journal gpstag-iofN.journal. With "--dedup" identical images are read and
+tagged only once, the duplicates get a copy of the tagged image. Like exiftool
+the untagged duplicate is kept as filename_original. Names of the same file
+(symbolic or hard links) count as one file, only the name given first is tagged.
+"""
+
+def do_gpstz(dz):
+   try:
+      w = int(dz)
+   except ValueError:
+      print "numerical values only"
+      return
+      
+   conf.glodata["gpstimezone"] = w
+   print "GPS time zone set to", w
+   
+def do_maxgap(s):
+   try:
+      w = int(s)
+   except ValueError:
+      print "numerical values only"
+      return
+      
+   conf.glodata["maxgap"] = w
+   print "max. interpolation gap set to %s seconds" % (w,)
+
+def do_sync(fnm,d,h):
+   try:
+      rdouttime = decodetime(d + " " + h)
+   except ValueError:
+      print "enter time in the following format: JJJJ.MM.TT HH:MM:SS"
+      return
+      
+   res = sync(fnm,rdouttime)
+   conf.setsync(res["model"],res["diff"],res["date"])
+
+# Sharding
+#
+# Large file sets can be split into N shards, which are processed
+# independently (on several hosts or one after another). The shard of a
+# file depends only on its base name, so every host computes the same
+# split from the same file list.
+
+def parseshard(s):
+   """ "i/N" -> (i, N), shards are numbered 1 ... N
+   """
+   (i,n) = s.split("/")
+   i = int(i)
+   n = int(n)
+   if n < 1 or i < 1 or i > n:
+      raise ValueError, "invalid shard: " + s
+   return (i,n)
+
+def inshard(fnm,shard):
+   """ True if file fnm belongs to shard (i, N)
+   """
+   import hashlib
+   (i,n) = shard
+   h = int(hashlib.md5(os.path.basename(fnm)).hexdigest()[:8],16)
+   return h % n == i - 1
+
+def journalname(shard):
+   return "gpstag-%dof%d.journal" % shard
+
+def writejournal(fnm,entries):
+   """ write the tagging journal, one line per tagged image, sorted by time:
+       time <tab> lon <tab> lat <tab> ele <tab> file name
+   """
+   entries.sort()
+   f = open(fnm,"w")
+   for (t,lon,lat,ele,name) in entries:
+      if ele == None:
+         ele = ""
+      f.write("%s\t%s\t%s\t%s\t%s\n" % (t.strftime("%Y-%m-%dT%H:%M:%SZ"),lon,lat,ele,name))
+   f.close()
+
+# Duplicate detection
+
+def fingerprint(fnm,hashed = None):
+   """ cheap fingerprint of a file: size and MD5 of the first and the last block
+
+       hashed: optional counter, hashed[0] sums up the bytes read
+   """
+   import hashlib
+   size = os.path.getsize(fnm)
+   f = open(fnm,"rb")
+   data = f.read(dedupblock)
+   h = hashlib.md5(data)
+   cnt = len(data)
+   if size > dedupblock:
+      f.seek(max(dedupblock,size - dedupblock))
+      data = f.read(dedupblock)
+      h.update(data)
+      cnt += len(data)
+   f.close()
+   if hashed != None:
+      hashed[0] += cnt
+   return (size,h.hexdigest())
+
+def fullhash(fnm,hashed = None):
+   """ MD5 of the whole file, hashed: see fingerprint """
+   import hashlib
+   h = hashlib.md5()
+   f = open(fnm,"rb")
+   while True:
+      data = f.read(1 << 20)
+      if not data:
+         break
+      h.update(data)
+      if hashed != None:
+         hashed[0] += len(data)
+   f.close()
+   return h.hexdigest()
+
+def groupby(fnmlist,keyfunc):
+   """ group the files by keyfunc, keeps the order of the first appearance
+   """
+   groups = {}
+   order = []
+   for fnm in fnmlist:
+      try:
+         key = keyfunc(fnm)
+      except (IOError, OSError):
+         key = fnm                 # unreadable files are never duplicates
+      if key not in groups:
+         groups[key] = []
+         order.append(key)
+      groups[key].append(fnm)
+   return [groups[key] for key in order]
+
+def finddups(fnmlist,hashed = None):
+   """ group identical files, returns a list of file lists
+
+       the first file of each list is the one to process, the others are
+       its duplicates. Files are compared by fingerprint, the whole
+       content is hashed only if fingerprints collide, so every duplicate
+       is read completely. A file named twice (also by a symbolic or hard
+       link) is processed once. hashed: optional counter, hashed[0] sums
+       up the bytes read for the comparison.
+   """
+   seen = {}
+   unique = []
+   for fnm in fnmlist:
+      try:
+         st = os.stat(fnm)
+         key = (st.st_dev,st.st_ino)
+      except OSError:
+         key = os.path.realpath(fnm)
+      if key not in seen:
+         seen[key] = True
+         unique.append(fnm)
+
+   res = []
+   for group in groupby(unique,lambda fnm: fingerprint(fnm,hashed)):
+      if len(group) == 1:
+         res.append(group)
+      else:
+         res.extend(groupby(group,lambda fnm: fullhash(fnm,hashed)))
+   return res
+
+def copytagged(fnm,dup):
+   """ replace the duplicate dup by a copy of the tagged image fnm
+
+       like exiftool the untagged dup is kept as dup_original unless that
+       backup exists already. The copy is written to a temporary file
+       which is renamed to dup, dup is never written in place.
+   """
+   import shutil, tempfile
+   (fd,tmp) = tempfile.mkstemp(prefix = ".pos2exif",dir = os.path.dirname(dup) or ".")
+   os.close(fd)
+   try:
+      shutil.copy2(fnm,tmp)
+      backup = dup + "_original"
+      if not os.path.exists(backup):
+         os.rename(dup,backup)
+      os.rename(tmp,dup)
+   except (IOError, OSError):
+      if os.path.exists(tmp):
+         os.remove(tmp)
+      raise
+
+def do_syncbatch(manifest):
+   """ sync offsets of several cameras from a manifest of reference images
+
+       manifest lines: file name JJJJ.MM.TT HH:MM:SS (time read out from the
+       GPS display), empty lines and lines starting with # are ignored.
+       The offset of each model is the median of its reference images.
+   """
+   entries = []
+   f = open(manifest)
+   for line in f:
+      line = line.strip()
+      if not line or line.startswith("#"):
+         continue
+      try:
+         (fnm,d,h) = line.rsplit(None,2)
+         entries.append((fnm,decodetime(d + " " + h)))
+      except ValueError:
+         print "invalid line in manifest:",line
+   f.close()
+
+   print "Reading %s reference images" % (len(entries),)
+   imdata = getImageDataBatch([e[0] for e in entries])
+
+   offsets = {}        # model -> [(offset, image time), ...]
+   for (fnm,rdouttime) in entries:
+      if fnm not in imdata:
+         print "%s: no exif data found" % (fnm,)
+         continue
+      im = imdata[fnm]
+      offsets.setdefault(im["model"],[]).append((syncoffset(im["date"],rdouttime),im["date"]))
+
+   for model in sorted(offsets):
+      diffs = sorted([o[0] for o in offsets[model]])
+      dif = median(diffs)
+      print "%s: %s reference images, offsets %s ... %s s" % (model,len(diffs),diffs[0],diffs[-1])
+      if diffs[-1] - diffs[0] > 60:
+         print "Warning: offsets of %s differ by more than a minute, check the read-out times" % (model,)
+      conf.setsync(model,dif,max([o[1] for o in offsets[model]]))
+
+def do_gpstag(gpx,filelist, overwrite = False, shard = None, dedup = False):
+   import xml.parsers.expat
+   if shard:
+      allfiles = len(filelist)
+      filelist = [fnm for fnm in filelist if inshard(fnm,shard)]
+      print "Shard %s/%s: %s of %s files" % (shard[0],shard[1],len(filelist),allfiles)
+   journal = []
+
+   print "Reading track file:",gpx
+   segments = []
+   try:
+      reftrack = readTrack(gpx,segments)
+   except (xml.parsers.expat.ExpatError, ValueError):
+      print "unsuitable track file"
+      sys.exit(ERR_GPX_FORMAT_INVALID)
+      
+   print "sorting points"
+   reftrack.sort()
+   print "Number of usable points:",len(reftrack)
+   if not reftrack:
+      sys.exit(ERR_GPX_FORMAT_INVALID)
+   index = trackindex(reftrack)
+   coverage = trackcoverage(reftrack,segments,conf.glodata.get("maxgap"))
+   print "Track covers %s time intervals" % (len(coverage.starts),)
+
+   if dedup:
+      print "Searching duplicates"
+      hashed = [0]
+      groups = finddups(filelist,hashed)
+   else:
+      groups = [[fnm] for fnm in filelist]
+
+   cnterr = 0
+   cntfiles = 0
+   cntdups = 0
+   cntcopies = 0
+   copied = 0
+   for group in groups:
+      fnm = group[0]
+      print fnm
+      cntfiles += len(group)
+      cntdups += len(group) - 1
+      w = getPosition(reftrack, fnm, gpsoverwrite = overwrite, index = index, coverage = coverage)
+      if w:
+         erg = setPosition(fnm,w)
+         if erg[0]:
+            print "Error %s\n%s\n" % erg
+            cnterr += len(group)
+         else:
+            journal.append((w[0],w[1],w[2],w[3],fnm))
+            # the duplicates get a copy of the tagged file
+            for dup in group[1:]:
+               print "%s (duplicate of %s)" % (dup,fnm)
+               try:
+                  copytagged(fnm,dup)
+               except (IOError, OSError), e:
+                  print "Error copying %s\n%s\n" % (fnm,e)
+                  cnterr += 1
+                  continue
+               journal.append((w[0],w[1],w[2],w[3],dup))
+               cntcopies += 1
+               copied += os.path.getsize(dup)
+      else:
+         cnterr += len(group)
+         
+   if cnterr:
+      print "%s files processed, %s errors" % (cntfiles, cnterr)
+   else:
+      print "%s files processed" % (cntfiles,)
+   if dedup:
+      # every duplicate costs a full hash (and a copy) instead of the
+      # exiftool runs reading and writing its EXIF data
+      print "%s duplicates: %s exiftool runs saved, %.1f MB hashed, %.1f MB copied" % (cntdups,cntdups + cntcopies,hashed[0] / 1048576.0,copied / 1048576.0)
+
+   if shard:
+      print "Writing journal:",journalname(shard)
+      writejournal(journalname(shard),journal)
+
+def do_mergejournal(out,journals):
+   """ merge the (time sorted) journals of several shards into one
+   """
+   files = [open(fnm) for fnm in journals]
+   f = open(out,"w")
+   cnt = 0
+   for line in heapq.merge(*files):
+      f.write(line)
+      cnt += 1
+   f.close()
+   for fl in files:
+      fl.close()
+   print "%s entries from %s journals written to %s" % (cnt,len(journals),out)
+
+def do_listsync():
+   pass
+
+def main(cmdline):
+   global conf
+
+
+   shard = None
+   if "--shard" in cmdline:
+      k = cmdline.index("--shard")
+      try:
+         shard = parseshard(cmdline[k+1])
+      except (IndexError, ValueError):
+         usage()
+         sys.exit(ERR_SHARD_INVALID)
+      del cmdline[k:k+2]
+
+   dedup = False
+   if "--dedup" in cmdline:
+      dedup = True
+      cmdline.remove("--dedup")
+
+   if len(cmdline)<2:
+      usage()
+      sys.exit(ERR_NOT_ENOUGH_PARAMETERS)
+
+   cmd = cmdline[1].lower()    # ignore case in command keyword
+
+   if cmd == "help":
+      usage()
+      sys.exit(0)
+
+   if cmd == "mergejournal":
+      if len(cmdline) < 4:
+         usage()
+         sys.exit(ERR_NOT_ENOUGH_PARAMETERS)
+      do_mergejournal(cmdline[2],cmdline[3:])
+      sys.exit(0)
+
+   if cmd in ("gpstz","maxgap","listsync"):
+      # lightweight commands: no DOM
+      try:
+         conf = quickconfig(configfilename,"pos2exif",1,globelements = confelements)
+      except ValueError:
+         conf = config(configfilename,"pos2exif",1,defaults = confdefaults,globelements = confelements)
+   else:
+      conf = config(configfilename,"pos2exif",1,defaults = confdefaults,globelements = confelements)
+
+   if cmd == "gpstz":
+      try:
+         do_gpstz(cmdline[2])
+      except IndexError:
+         usage()
+         sys.exit(ERR_TIME_ZONE_INVALID)
+      
+   if cmd == "maxgap":
+      try:
+         do_maxgap(cmdline[2])
+      except IndexError:
+         usage()
+         sys.exit(ERR_NOT_ENOUGH_PARAMETERS)
+
+   if cmd == "sync":
+      preflightcheck()
+      try:
+         do_sync(cmdline[2],cmdline[3],cmdline[4])
+      except IndexError:
+         usage()
+         sys.exit(ERR_SYNC_TIME_FORMAT_INVALID)
+
+   if cmd == "syncbatch":
+      preflightcheck()
+      try:
+         do_syncbatch(cmdline[2])
+      except IndexError:
+         usage()
+         sys.exit(ERR_NOT_ENOUGH_PARAMETERS)
+
+   if cmd == "gpstag":
+      preflightcheck()
+      try:
+         do_gpstag(cmdline[2], cmdline[3:], overwrite = False, shard = shard, dedup = dedup)
+      except IndexError:
+         usage()
+         sys.exit(ERR_NOT_ENOUGH_PARAMETERS)
+
+   if cmd == "gpstagovr":
+      preflightcheck()
+      try:
+         do_gpstag(cmdline[2], cmdline[3:], overwrite = True, shard = shard, dedup = dedup)
+      except IndexError:
+         usage()
+         sys.exit(ERR_NOT_ENOUGH_PARAMETERS)
+
+   if cmd == "listsync":
+      conf.listsync()
+      sys.exit(0)
+
+   conf.writedata()
+